@@ -0,0 +1,38 @@
+import timeit
+import numpy as np
+from oed_toolbox import utils
+
+#
+#   Benchmark of the Laplace posterior's derivative contractions (see distributions.Posterior.laplace_approximation),
+#   comparing left-to-right contraction, re-planning the optimal path on every call and utils._einsum's cached paths
+#
+
+def laplace_contractions(num_samples, theta_dim, y_dim, d_dim, rng):
+    theta = rng.normal(size=(num_samples, theta_dim))
+    icov = rng.normal(size=(num_samples, theta_dim, theta_dim))
+    return [
+        ('aijk,ai,aj->ak', rng.normal(size=(num_samples, theta_dim, theta_dim, d_dim)), theta, theta),
+        ('alk,ali,ai->ak', rng.normal(size=(num_samples, theta_dim, d_dim)), icov, theta),
+        ('aijl,ik,ak->ajl', rng.normal(size=(num_samples, y_dim, theta_dim, d_dim)), rng.normal(size=(y_dim, y_dim)),
+                            rng.normal(size=(num_samples, y_dim))),
+        ('akim,kl,alj->aijm', rng.normal(size=(num_samples, y_dim, theta_dim, d_dim)), rng.normal(size=(y_dim, y_dim)),
+                              rng.normal(size=(num_samples, y_dim, theta_dim))),
+    ]
+
+def time_contractions(contractions, einsum, number):
+    return min(timeit.repeat(lambda : [einsum(subscripts, *operands) for subscripts, *operands in contractions], number=number, repeat=5))/number
+
+def main(number=20):
+    rng = np.random.default_rng(0)
+    einsums = {'left-to-right': np.einsum,
+               'optimal (re-planned)': lambda subscripts, *operands : np.einsum(subscripts, *operands, optimize='optimal'),
+               'optimal (cached)': utils._einsum}
+    for num_samples, theta_dim, y_dim, d_dim in [(100, 5, 20, 3), (1000, 5, 20, 3), (1000, 10, 50, 5)]:
+        contractions = laplace_contractions(num_samples, theta_dim, y_dim, d_dim, rng)
+        times = {name: time_contractions(contractions, einsum, number) for name, einsum in einsums.items()}
+        print(f'num_samples = {num_samples}, theta_dim = {theta_dim}, y_dim = {y_dim}, d_dim = {d_dim}:')
+        for name, time in times.items():
+            print(f'    {name}: {1e3*time:.3f} ms ({times["left-to-right"]/time:.1f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,15 @@
-__all__ = ['losses', 'models', 'optim', 'distributions', 'covariances']
-from . import *
\ No newline at end of file
+import importlib
+
+__all__ = ['losses', 'models', 'optim', 'distributions', 'covariances', 'profiling', 'parallel', 'compilation', 'batching', 'quadrature']
+
+# Submodules are only imported when first accessed (e.g. oed_toolbox.losses), so that
+# 'import oed_toolbox' doesn't pay for importing every submodule up-front:
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module(f'.{name}', __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def __dir__():
+    return sorted([*globals(), *__all__])
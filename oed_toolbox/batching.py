@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import numpy as np
+from . import profiling, utils
+
+class MicroBatchedModel:
+
+    def __init__(self, model, max_batch_size=1024, max_delay=1e-3, max_pending=None):
+        # Concurrent predict* requests made within max_delay seconds of one another are coalesced into
+        # a single call of the wrapped model, which is made as soon as max_batch_size rows are queued:
+        self._model = model
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay
+        self._queues = {}
+        self._queued_rows = {}
+        self._flush_handles = {}
+        # Requests are batched by an event loop running in a background thread:
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._pending = asyncio.run_coroutine_threadsafe(self._create_semaphore(max_pending), self._loop).result()
+
+    #
+    #   Prediction Methods
+    #
+
+    def predict(self, theta, d):
+        return self._submit('predict', theta, d).result()
+
+    def predict_dt(self, theta, d):
+        return self._submit('predict_dt', theta, d).result()
+
+    def predict_dd(self, theta, d):
+        return self._submit('predict_dd', theta, d).result()
+
+    def predict_dt_dt(self, theta, d):
+        return self._submit('predict_dt_dt', theta, d).result()
+
+    def predict_dt_dd(self, theta, d):
+        return self._submit('predict_dt_dd', theta, d).result()
+
+    async def evaluate(self, method, theta, d):
+        # Awaitable version of the predict* methods, which can be used from any event loop:
+        return await asyncio.wrap_future(self._submit(method, theta, d))
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    #
+    #   Batching Methods
+    #
+
+    @staticmethod
+    async def _create_semaphore(max_pending):
+        # Semaphore must be created inside the batching event loop:
+        return asyncio.Semaphore(max_pending) if max_pending is not None else None
+
+    def _submit(self, method, theta, d):
+        return asyncio.run_coroutine_threadsafe(self._enqueue(method, theta, d), self._loop)
+
+    async def _enqueue(self, method, theta, d):
+        theta, d = utils._preprocess_inputs(theta=theta, d=d)
+        # Backpressure - wait until fewer than max_pending requests are in flight:
+        if self._pending is not None:
+            await self._pending.acquire()
+        try:
+            future = self._loop.create_future()
+            num_rows = theta.shape[0]
+            if self._queued_rows.get(method, 0) + num_rows > self._max_batch_size:
+                self._flush(method)
+            self._queues.setdefault(method, []).append((theta, d, future))
+            self._queued_rows[method] = self._queued_rows.get(method, 0) + num_rows
+            if self._queued_rows[method] >= self._max_batch_size:
+                self._flush(method)
+            elif method not in self._flush_handles:
+                self._flush_handles[method] = self._loop.call_later(self._max_delay, self._flush, method)
+            return await future
+        finally:
+            if self._pending is not None:
+                self._pending.release()
+
+    def _flush(self, method):
+        handle = self._flush_handles.pop(method, None)
+        if handle is not None:
+            handle.cancel()
+        requests = self._queues.pop(method, [])
+        self._queued_rows.pop(method, None)
+        if requests:
+            self._loop.create_task(self._dispatch(method, requests))
+
+    async def _dispatch(self, method, requests):
+        theta = np.concatenate([theta_i for theta_i, _, _ in requests], axis=0)
+        d = np.concatenate([d_i for _, d_i, _ in requests], axis=0)
+        profiling._count(f'batching.{method}', theta.shape[0])
+        try:
+            # Don't block the event loop whilst the model is evaluated:
+            outputs = await self._loop.run_in_executor(None, getattr(self._model, method), theta, d)
+        except Exception as error:
+            for _, _, future in requests:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        # Scatter outputs back to each request:
+        split_idx = np.cumsum([theta_i.shape[0] for theta_i, _, _ in requests])[:-1]
+        for (_, _, future), output in zip(requests, np.split(np.asarray(outputs), split_idx, axis=0)):
+            if not future.done():
+                future.set_result(output)
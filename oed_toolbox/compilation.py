@@ -0,0 +1,142 @@
+import os
+import hashlib
+from . import profiling
+
+class CompilationCache:
+
+    def __init__(self, cache_dir, use_persistent_cache=True):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        # hits = loaded from disk, misses = exported to disk, fallbacks = stored export couldn't be used:
+        self.stats = {'hits': 0, 'misses': 0, 'fallbacks': 0}
+        self._loaded_funcs = {}
+        if use_persistent_cache:
+            _enable_persistent_cache(cache_dir)
+
+    def wrap(self, func, key):
+        import jax
+        import jax.numpy as jnp
+        jitted_func = jax.jit(func)
+        def cached_func(*args):
+            args = [jnp.asarray(arg) for arg in args]
+            # Exports are specific to the backend they were compiled for:
+            name = f'{key}-{jax.default_backend()}-{_input_signature(args)}'
+            if name in self._loaded_funcs:
+                return self._loaded_funcs[name](*args)
+            self._loaded_funcs[name], output = self._load_or_export(jitted_func, name, args)
+            return output
+        return cached_func
+
+    def _load_or_export(self, jitted_func, name, args):
+        # Returns the function to use for these inputs, along with its output for args:
+        import jax
+        export = _get_export_module()
+        if export is None:
+            # Exporting not supported by this JAX version - fall back on the persistent compilation cache:
+            return jitted_func, jitted_func(*args)
+        path = os.path.join(self.cache_dir, _hash_name(name) + '.jaxexport')
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    exported = export.deserialize(bytearray(f.read()))
+                _check_input_shapes(exported, args)
+                loaded_func = jax.jit(exported.call)
+                # Exports which can't be run here (e.g. compiled for another platform) only fail once called:
+                output = jax.block_until_ready(loaded_func(*args))
+                self._record('hits')
+                return loaded_func, output
+            except Exception:
+                self._record('fallbacks')
+        else:
+            self._record('misses')
+        try:
+            exported = export.export(jitted_func)(*args)
+            loaded_func = jax.jit(exported.call)
+            output = jax.block_until_ready(loaded_func(*args))
+        except Exception:
+            return jitted_func, jitted_func(*args)
+        with open(path, 'wb') as f:
+            f.write(exported.serialize())
+        return loaded_func, output
+
+    def _record(self, key):
+        self.stats[key] += 1
+        profiling._count(f'compilation_cache.{key}')
+
+#
+#   Helper Functions
+#
+
+def _function_key(func):
+    # Identify a function by its name and bytecode, along with the bytecode (or contents) of any globals it references.
+    # Values captured in a closure (e.g. trained surrogate parameters) can't be reliably identified, so such functions (and 
+    # callables without bytecode, like functools.partial objects or jitted functions) need an explicit cache_key - as do
+    # functions which reference globals without a stable representation - see _global_contents:
+    import jax
+    if not hasattr(func, '__code__'):
+        raise TypeError(f'Unable to identify {func!r} for caching, since it has no bytecode - must specify cache_key.')
+    if func.__closure__:
+        raise ValueError(f'Unable to identify {func.__qualname__} for caching, since it captures values in a closure - must specify cache_key.')
+    contents = f'{func.__module__}.{func.__qualname__}|{_code_contents(func.__code__, func.__globals__, set())}|{jax.__version__}'
+    return f'{func.__qualname__}-{_hash_name(contents)}'
+
+def _code_contents(code, func_globals, visited):
+    # Nested code objects (e.g. lambdas) are identified by their contents, rather than by their (memory address dependent) repr:
+    consts = [_code_contents(const, func_globals, visited) if hasattr(const, 'co_code') else repr(const) for const in code.co_consts]
+    referenced = [_global_contents(func_globals[name], visited) for name in code.co_names if name in func_globals]
+    return f"{code.co_code.hex()}|{','.join(consts)}|{','.join(referenced)}"
+
+def _global_contents(val, visited):
+    # Globals are identified by their contents, rather than their repr, since reprs may truncate (e.g. large arrays)
+    # or depend on memory addresses (e.g. most objects):
+    import numpy as np
+    if hasattr(val, '__wrapped__') and not hasattr(val, '__code__'):
+        # e.g. jax.jit(func):
+        return f'wrapped:{_global_contents(val.__wrapped__, visited)}'
+    if hasattr(val, '__code__'):
+        # Don't recurse forever through (mutually) recursive functions:
+        if id(val.__code__) in visited:
+            return val.__qualname__
+        visited.add(id(val.__code__))
+        return f'{val.__qualname__}:{_code_contents(val.__code__, val.__globals__, visited)}'
+    if isinstance(val, type(np)):
+        return f"{val.__name__}:{getattr(val, '__version__', '')}"
+    if hasattr(val, '__array__'):
+        # Numpy and JAX arrays (and scalars):
+        val = np.asarray(val)
+        return _hash_name(f'{val.dtype}{val.shape}') + hashlib.sha256(np.ascontiguousarray(val).tobytes()).hexdigest()[:32]
+    if isinstance(val, dict):
+        items = sorted([(repr(key), _global_contents(item, visited)) for key, item in val.items()])
+        return '{' + ','.join(f'{key}:{item}' for key, item in items) + '}'
+    if isinstance(val, (list, tuple)):
+        return f"{type(val).__name__}({','.join(_global_contents(item, visited) for item in val)})"
+    if (val is None) or isinstance(val, (bool, int, float, complex, str, bytes)):
+        return repr(val)
+    if isinstance(val, (type, np.ufunc)) or type(val).__name__ == 'builtin_function_or_method':
+        # Classes and built-in functions are identified by name:
+        return f"{getattr(val, '__module__', '')}.{getattr(val, '__qualname__', val.__name__)}"
+    raise ValueError(f'Unable to identify global {type(val).__name__} object for caching - must specify cache_key.')
+
+def _input_signature(args):
+    return '_'.join([f"{arg.dtype}[{','.join(str(dim) for dim in arg.shape)}]" for arg in args])
+
+def _hash_name(name):
+    return hashlib.sha256(name.encode()).hexdigest()[:32]
+
+def _check_input_shapes(exported, args):
+    for aval, arg in zip(exported.in_avals, args):
+        if (tuple(aval.shape) != tuple(arg.shape)) or (aval.dtype != arg.dtype):
+            raise ValueError('Exported function signature does not match inputs.')
+
+def _get_export_module():
+    try:
+        from jax import export
+    except ImportError:
+        export = None
+    return export
+
+def _enable_persistent_cache(cache_dir):
+    import jax
+    jax.config.update('jax_compilation_cache_dir', cache_dir)
+    # Cache every compiled executable, not just the slow-to-compile ones:
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
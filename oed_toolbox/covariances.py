@@ -1,8 +1,11 @@
 import numpy as np
-from . import utils
+from . import profiling, utils
 
 class Covariance:
 
+    # Whether num_samples or samples must be specified when called:
+    _requires_samples = True
+
     def __init__(self, cov=None, cov_dd=None, cov_and_grads=None):
         if cov_and_grads is None:
             cov_and_grads = self._create_cov_and_grads(cov, cov_dd)
@@ -20,23 +23,179 @@ class Covariance:
         return _create_cov_and_grads
 
     def __call__(self, d, theta_estimate, num_samples=None, rng=None, return_cov=True, return_dd=True, samples=None):
-        if (num_samples is None) and (samples is None):
+        if self._requires_samples and (num_samples is None) and (samples is None):
             raise ValueError('Must specify either num_samples or samples.')
-        return self._func_dict['cov_and_grads'](d, theta_estimate, num_samples, rng, return_dd, samples)
+        with profiling._timer(type(self).__name__):
+            return self._func_dict['cov_and_grads'](d, theta_estimate, num_samples, rng, return_dd, samples)
 
-class FisherInformation(Covariance):
+class FisherInformation(Covariance, utils._Estimator):
 
-    def __init__(self, likelihood, apply_control_variates=True, use_reparameterisation=False):
-        if use_reparameterisation:
-            cov_and_grad =  self._create_reparameterisation_fisher_info(likelihood, apply_control_variates)
+    def __init__(self, likelihood, apply_control_variates=None, use_reparameterisation=False, use_closed_form=None, num_pilot_samples=50, num_pilot_repeats=5, 
+                 recycle_samples=False, ess_threshold=0.5, low_fidelity=None, low_fidelity_ratio=10, quadrature_level=None, sparse_grid=False,
+                 return_quadrature_error=False):
+        # By default, control variates are applied unless a low_fidelity estimate is used, and the exact Fisher information 
+        # is used whenever the likelihood provides it:
+        if apply_control_variates is None:
+            apply_control_variates = low_fidelity is None
+        if use_closed_form is None:
+            use_closed_form = likelihood.has_closed_form_fisher_information and (low_fidelity is None) and (quadrature_level is None) and \
+                              (not recycle_samples)
+        elif use_closed_form and not likelihood.has_closed_form_fisher_information:
+            raise ValueError('Likelihood does not provide a closed-form Fisher information.')
+        self._set_estimator_options(likelihood, num_pilot_samples, num_pilot_repeats, recycle_samples, ess_threshold, low_fidelity, 
+                                    low_fidelity_ratio, quadrature_level, sparse_grid, return_quadrature_error, 
+                                    use_closed_form=use_closed_form, apply_control_variates=apply_control_variates)
+        if low_fidelity is not None:
+            if low_fidelity._use_closed_form:
+                raise ValueError('low_fidelity must be a sampling estimate - construct it with use_closed_form=False.')
+            if (use_reparameterisation is not False) and (True not in low_fidelity._sample_cov_funcs):
+                raise ValueError('low_fidelity estimate must support the same estimators as this estimate.')
+        self._use_closed_form = use_closed_form
+        self._requires_samples = (not use_closed_form) and (quadrature_level is None)
+        if use_closed_form:
+            cov_and_grad = self._create_closed_form_fisher_info(likelihood)
         else:
-            cov_and_grad = self._create_fisher_info(likelihood, apply_control_variates)
+            # use_reparameterisation='auto' and/or apply_control_variates='auto' chooses the estimator using
+            # a short pilot run - see select_estimator:
+            self._sample_cov_funcs = {False: self._create_fisher_info(likelihood)}
+            if use_reparameterisation:
+                self._sample_cov_funcs[True] = self._create_reparameterisation_fisher_info(likelihood)
+            cov_and_grad = self._cov_and_grad
+        self._auto_select = (not use_closed_form) and ((use_reparameterisation == 'auto') or (apply_control_variates == 'auto'))
+        self._estimator = {'use_reparameterisation': use_reparameterisation is True, 'apply_control_variates': apply_control_variates is True}
+        self._auto_options = {'use_reparameterisation': [use_reparameterisation is True] if use_reparameterisation != 'auto' else [False, True],
+                              'apply_control_variates': [apply_control_variates is True] if apply_control_variates != 'auto' else [False, True]}
         super().__init__(cov_and_grads=cov_and_grad)
 
+    def __call__(self, d, theta_estimate, num_samples=None, rng=None, return_cov=True, return_dd=True, samples=None, pool=None, seed=None):
+        # num_samples, rng, samples, pool and seed are ignored if quadrature_level was specified:
+        if self._quadrature_level is not None:
+            return self._quadrature_cov(d, theta_estimate, return_dd)
+        if self._auto_select:
+            self.select_estimator(d, theta_estimate, rng=rng)
+        # Closed-form Fisher information doesn't require any samples, so there's nothing to shard:
+        if (pool is None) or self._use_closed_form:
+            return super().__call__(d, theta_estimate, num_samples, rng, return_cov, return_dd, samples)
+        if (num_samples is None) and (samples is None):
+            raise ValueError('Must specify either num_samples or samples.')
+        if num_samples is None:
+            num_samples = samples.shape[0]
+        with profiling._timer(type(self).__name__):
+            stats = pool.map_shards('_cov_statistics', num_samples, samples, seed, rng, d=d, theta=theta_estimate, return_dd=return_dd, 
+                                    estimator=self._estimator)
+            return {key: utils._estimate_from_statistics(val) for key, val in stats.items()}
+
+    def _cov_and_grad(self, d, theta, num_samples, rng, return_dd, samples):
+        stats = self._cov_statistics(d, theta, num_samples, samples, rng, return_dd, self._estimator)
+        return {key: utils._estimate_from_statistics(val) for key, val in stats.items()}
+
+    def _cov_statistics(self, d, theta, num_samples, samples, rng, return_dd, estimator, use_recycler=True):
+        if self._low_fidelity is not None:
+            if samples is not None:
+                raise ValueError('User-specified samples cannot be used with a low_fidelity estimate.')
+            return self._multi_fidelity_statistics(d, theta, num_samples, rng, return_dd, estimator['use_reparameterisation'])
+        weights, num_groups = None, None
+        if np.ndim(theta) > 1:
+            # Batch of theta estimates - num_samples samples are drawn for each estimate, ordered so that sample a of 
+            # estimate k is row a*num_estimates + k; samples must then be of shape (num_samples, num_estimates, dim):
+            if self._recycler is not None:
+                raise ValueError('Sample recycling is not supported for batches of theta estimates.')
+            if num_samples is None:
+                num_samples = samples.shape[0]
+            num_groups = np.shape(theta)[0]
+            theta = np.tile(theta, (num_samples, 1))
+            if samples is not None:
+                samples = samples.reshape(num_samples*num_groups, -1)
+        elif (samples is None) and use_recycler and (self._recycler is not None) and (not estimator['use_reparameterisation']):
+            sample = lambda d, num_samples, rng : {'theta': np.atleast_2d(theta), 'y': self._likelihood.sample(theta, d, num_samples, rng)}
+            recycled, weights = self._recycler.get_samples(sample, d, num_samples, rng, theta=theta)
+            samples = recycled['y']
+        sample_cov_and_grad = self._sample_cov_funcs[estimator['use_reparameterisation']]
+        num_rows = num_samples if num_groups is None else num_samples*num_groups
+        outputs, cv = sample_cov_and_grad(d, theta, num_rows, rng, return_dd, samples, estimator['apply_control_variates'])
+        if num_groups is not None:
+            # Control variates are fitted separately for each theta estimate:
+            outputs = {key: val.reshape(num_samples, num_groups, *val.shape[1:]) for key, val in outputs.items()}
+        cv_list = [cv] if cv is not None else []
+        return {key: utils._sample_statistics(val, cv_list, weights, num_groups) for key, val in outputs.items()}
+
+    def _multi_fidelity_statistics(self, d, theta, num_samples, rng, return_dd, use_reparameterisation):
+        # Both fidelities share the same noise samples, so that their estimates are correlated:
+        num_lf_samples = max(int(np.ceil(self._low_fidelity_ratio*num_samples)), num_samples)
+        batched = np.ndim(theta) > 1
+        num_groups = np.shape(theta)[0] if batched else 1
+        if batched:
+            # Same sample ordering as for batches of theta estimates in _cov_statistics:
+            theta = np.tile(theta, (num_lf_samples, 1))
+        epsilon = self._likelihood.sample_base(num_lf_samples*num_groups, rng)
+        num_hf_rows = num_samples*num_groups
+        hf_outputs = self._outputs_from_base_samples(d, theta[:num_hf_rows] if batched else theta, epsilon[:num_hf_rows], return_dd, use_reparameterisation)
+        lf_outputs = self._low_fidelity._outputs_from_base_samples(d, theta, epsilon, return_dd, use_reparameterisation)
+        if batched:
+            hf_outputs = {key: val.reshape(num_samples, num_groups, *val.shape[1:]) for key, val in hf_outputs.items()}
+            lf_outputs = {key: val.reshape(num_lf_samples, num_groups, *val.shape[1:]) for key, val in lf_outputs.items()}
+        return {key: utils._multi_fidelity_statistics(val, lf_outputs[key]) for key, val in hf_outputs.items()}
+
+    def _outputs_from_base_samples(self, d, theta, epsilon, return_dd, use_reparameterisation):
+        samples = epsilon if use_reparameterisation else self._likelihood.transform(epsilon, theta, d)['y']
+        outputs, _ = self._sample_cov_funcs[use_reparameterisation](d, theta, epsilon.shape[0], None, return_dd, samples, False)
+        return outputs
+
+    def _quadrature_cov(self, d, theta, return_dd):
+        use_reparameterisation = self._estimator['use_reparameterisation']
+        def estimate(nodes, weights):
+            nodes, num_groups = nodes[0], None
+            if np.ndim(theta) > 1:
+                # Same ordering as for batches of theta estimates in _cov_statistics, with each node shared by all estimates:
+                num_groups = np.shape(theta)[0]
+                outputs = self._outputs_from_base_samples(d, np.tile(theta, (nodes.shape[0], 1)), np.repeat(nodes, num_groups, axis=0), 
+                                                          return_dd, use_reparameterisation)
+                outputs = {key: val.reshape(-1, num_groups, *val.shape[1:]) for key, val in outputs.items()}
+            else:
+                outputs = self._outputs_from_base_samples(d, theta, nodes, return_dd, use_reparameterisation)
+            return {key: utils._estimate_from_statistics(utils._sample_statistics(val, weights=weights, num_groups=num_groups)) 
+                    for key, val in outputs.items()}
+        with profiling._timer(type(self).__name__):
+            outputs, errors = self._quadrature_estimate(estimate, self._likelihood)
+        if errors is None:
+            return outputs
+        return {**outputs, **{f'{key}_error': val for key, val in errors.items()}}
+
+    def select_estimator(self, d, theta_estimate, num_samples=None, num_repeats=None, rng=None):
+        # Choose the cov_dd estimator at design d:
+        if self._use_closed_form:
+            return {}
+        candidates = []
+        for use_reparameterisation in self._auto_options['use_reparameterisation']:
+            # Control variates aren't applied to reparameterised estimates:
+            for apply_control_variates in ([False] if use_reparameterisation else self._auto_options['apply_control_variates']):
+                candidates.append({'use_reparameterisation': use_reparameterisation, 'apply_control_variates': apply_control_variates})
+        def pilot_grad(candidate, num_samples):
+            # Pilot always uses freshly drawn samples (i.e. not recycled ones):
+            stats = self._cov_statistics(d, theta_estimate, num_samples, None, rng, True, candidate, use_recycler=False)
+            return utils._estimate_from_statistics(stats['cov_dd'])
+        return self._select_estimator(candidates, pilot_grad, num_samples, num_repeats)
+
     @staticmethod
-    def _create_reparameterisation_fisher_info(likelihood, apply_control_variates):
+    def _create_closed_form_fisher_info(likelihood):
 
         def cov_and_grad(d, theta, num_samples, rng, return_dd, samples):
+            # Fisher information of a batch of theta estimates is computed in a single call:
+            fisher_vals = likelihood.fisher_information(theta, d, return_dd=return_dd)
+            outputs = {'cov': fisher_vals['fisher_info']}
+            if return_dd:
+                outputs['cov_dd'] = fisher_vals['fisher_info_dd']
+            # Remove batch dimension if only a single theta estimate was given:
+            if np.ndim(theta) < 2:
+                outputs = {key: val[0,:] for key, val in outputs.items()}
+            return outputs
+
+        return cov_and_grad
+
+    @staticmethod
+    def _create_reparameterisation_fisher_info(likelihood):
+
+        def cov_and_grad(d, theta, num_samples, rng, return_dd, samples, apply_control_variates):
             outputs = {}
             if samples is None:
                 epsilon = likelihood.sample_base(num_samples, rng)
@@ -44,20 +203,19 @@ class FisherInformation(Covariance):
                 epsilon = samples
             transform = likelihood.transform(epsilon, theta, d, return_dd)
             like_vals = likelihood.logpdf(transform['y'], theta, d, return_logpdf=False, return_dt=True, return_dt_dy=return_dd, return_dt_dd=return_dd)
-            outputs['cov'] = np.einsum('ai,aj->aij', like_vals['logpdf_dt'], like_vals['logpdf_dt'])
+            outputs['cov'] = utils._einsum('ai,aj->aij', like_vals['logpdf_dt'], like_vals['logpdf_dt'])
             if return_dd:
-                ll_dt_dd = np.einsum('ajk,aij->aik', transform['y_dd'], like_vals['logpdf_dt_dy']) + like_vals['logpdf_dt_dd']
-                outputs['cov_dd'] = 2*np.einsum('aik,aj->aijk', ll_dt_dd, like_vals['logpdf_dt'])
-            for key, val in outputs.items():
-                outputs[key] = np.mean(val, axis=0)
-            return outputs
+                ll_dt_dd = utils._einsum('ajk,aij->aik', transform['y_dd'], like_vals['logpdf_dt_dy']) + like_vals['logpdf_dt_dd']
+                outputs['cov_dd'] = 2*utils._einsum('aik,aj->aijk', ll_dt_dd, like_vals['logpdf_dt'])
+            # Control variates aren't applied to reparameterised estimates:
+            return outputs, None
 
         return cov_and_grad
 
     @staticmethod
-    def _create_fisher_info(likelihood, apply_control_variates):
+    def _create_fisher_info(likelihood):
 
-        def cov_and_grad(d, theta, num_samples, rng, return_dd, samples):
+        def cov_and_grad(d, theta, num_samples, rng, return_dd, samples, apply_control_variates):
             compute_dd = return_dd or apply_control_variates
             outputs = {}
             if samples is None:
@@ -65,43 +223,48 @@ class FisherInformation(Covariance):
             else:
                 y = samples
             like_vals = likelihood.logpdf(y, theta, d, return_logpdf=False, return_dt=True, return_dt_dd=return_dd, return_dd=compute_dd)
-            outputs['cov'] = np.einsum('ai,aj->aij', like_vals['logpdf_dt'], like_vals['logpdf_dt'])               
+            outputs['cov'] = utils._einsum('ai,aj->aij', like_vals['logpdf_dt'], like_vals['logpdf_dt'])               
             if return_dd:
                 outputs['cov_dd'] = \
-                np.einsum('ak,ai,aj->aijk', like_vals['logpdf_dd'], like_vals['logpdf_dt'], like_vals['logpdf_dt']) + \
-                np.einsum('aik,aj->aijk', like_vals['logpdf_dt_dd'], like_vals['logpdf_dt']) + \
-                np.einsum('ai,ajk->aijk', like_vals['logpdf_dt'], like_vals['logpdf_dt_dd'])
-            for key, val in outputs.items():
-                if apply_control_variates:
-                    outputs[key] = utils.apply_control_variates(val, cv=like_vals['logpdf_dd'])
-                else:
-                    outputs[key] = np.mean(val, axis=0)
-            return outputs
+                utils._einsum('ak,ai,aj->aijk', like_vals['logpdf_dd'], like_vals['logpdf_dt'], like_vals['logpdf_dt']) + \
+                utils._einsum('aik,aj->aijk', like_vals['logpdf_dt_dd'], like_vals['logpdf_dt']) + \
+                utils._einsum('ai,ajk->aijk', like_vals['logpdf_dt'], like_vals['logpdf_dt_dd'])
+            cv = like_vals['logpdf_dd'] if apply_control_variates else None
+            return outputs, cv
 
         return cov_and_grad
 
 class PredictiveCovariance(Covariance):
 
     def __init__(self, model, fisher_information):
+        self._requires_samples = fisher_information._requires_samples
+        self._fisher_information = fisher_information
         cov_and_grad = self._create_predictive_variance(model, fisher_information)
         super().__init__(cov_and_grads=cov_and_grad)
         
+    def select_estimator(self, d, theta_estimate, rng=None):
+        return self._fisher_information.select_estimator(d, theta_estimate, rng=rng)
+
     @staticmethod
     def _create_predictive_variance(model, fisher_information):
         def cov_and_grad(d, theta_estimate, num_samples, rng, return_dd, samples):
             outputs = {}
             cov_and_grad = fisher_information(d, theta_estimate, num_samples, rng, return_cov=True, return_dd=return_dd, samples=samples)
-            inv_fisher_info = np.linalg.inv(cov_and_grad['cov'])
-            # Remove batch dimension:
-            y_dt = model.predict_dt(theta_estimate, d)[0,:]
-            outputs['cov'] = np.einsum('ij,jk,kl->il', y_dt, inv_fisher_info, y_dt.T)
+            # Single theta estimates are treated as a batch of one:
+            batched = np.ndim(theta_estimate) > 1
+            fisher_info = cov_and_grad['cov'] if batched else cov_and_grad['cov'][None,:]
+            inv_fisher_info = np.linalg.inv(fisher_info)
+            y_dt = model.predict_dt(theta_estimate, d)
+            outputs['cov'] = utils._einsum('bij,bjk,blk->bil', y_dt, inv_fisher_info, y_dt)
             if return_dd:
-                # Remove batch dimension:
-                y_dt_dd = model.predict_dt_dd(theta_estimate, d)[0,:]
+                y_dt_dd = model.predict_dt_dd(theta_estimate, d)
                 # Derivative of inverse fisher info matrix - see Eqn (59) in Matrix cookbook (https://www2.imm.dtu.dk/pubdb/edoc/imm3274.pdf):
-                fisher_info_dd = cov_and_grad['cov_dd']
-                inv_fisher_info_dd = -1*np.einsum('ij,jkm,kl->ilm', inv_fisher_info, fisher_info_dd, inv_fisher_info)
-                outputs['cov_dd'] = 2*np.einsum('ijm,jk,kl->ilm', y_dt_dd, inv_fisher_info, y_dt.T) + \
-                                    np.einsum('ij,jkm,kl->ilm', y_dt, inv_fisher_info_dd, y_dt.T)
+                fisher_info_dd = cov_and_grad['cov_dd'] if batched else cov_and_grad['cov_dd'][None,:]
+                inv_fisher_info_dd = -1*utils._einsum('bij,bjkm,bkl->bilm', inv_fisher_info, fisher_info_dd, inv_fisher_info)
+                outputs['cov_dd'] = 2*utils._einsum('bijm,bjk,blk->bilm', y_dt_dd, inv_fisher_info, y_dt) + \
+                                    utils._einsum('bij,bjkm,blk->bilm', y_dt, inv_fisher_info_dd, y_dt)
+            # Remove batch dimension:
+            if not batched:
+                outputs = {key: val[0,:] for key, val in outputs.items()}
             return outputs
-        return cov_and_grad
\ No newline at end of file
+        return cov_and_grad
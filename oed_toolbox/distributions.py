@@ -1,7 +1,6 @@
 from math import pi
-import jax
 import numpy as np
-from . import utils
+from . import compilation, models, profiling, utils
 
 class Distribution:
 
@@ -23,15 +22,20 @@ class Distribution:
                 outputs[key] = val.reshape(num_samples, theta_dim, d_dim)
         return outputs
 
+    @staticmethod
+    def _broadcast_outputs(outputs, num_samples):
+        return {key: utils._broadcast_batch(val, num_samples) for key, val in outputs.items()}
+
 class Likelihood(Distribution):
 
-    def __init__(self, sample=None, logpdf=None, logpdf_dy=None, logpdf_dt=None, logpdf_dd=None, logpdf_dt_dt=None, logpdf_dt_dd=None, logpdf_dt_dy=None, logpdf_and_grads=None, sample_base=None, transform=None, transform_dd=None, transform_and_grads=None):
+    def __init__(self, sample=None, logpdf=None, logpdf_dy=None, logpdf_dt=None, logpdf_dd=None, logpdf_dt_dt=None, logpdf_dt_dd=None, logpdf_dt_dy=None, logpdf_and_grads=None, sample_base=None, transform=None, transform_dd=None, transform_and_grads=None, fisher_info_and_grads=None):
         if logpdf_and_grads is None:
             logpdf_and_grads = \
             self._create_logpdf_and_grads(logpdf, logpdf_dy, logpdf_dt, logpdf_dd, logpdf_dt_dt, logpdf_dt_dd, logpdf_dt_dy)
         if transform_and_grads is None:
             transform_and_grads = self._create_transform_and_grads(transform, transform_dd)
-        self._func_dict = {'sample': sample, 'sample_base': sample_base, 'logpdf_and_grads': logpdf_and_grads, 'transform_and_grads': transform_and_grads}
+        self._func_dict = {'sample': sample, 'sample_base': sample_base, 'logpdf_and_grads': logpdf_and_grads, 'transform_and_grads': transform_and_grads, 
+                           'fisher_info_and_grads': fisher_info_and_grads}
 
     #
     #   Sampling and Probability Methods
@@ -42,7 +46,8 @@ class Likelihood(Distribution):
             return AttributeError('Sampling function not specified.')
         theta, d = utils._preprocess_inputs(theta=theta, d=d)
         self._check_sample_dimension(num_samples, theta, d) 
-        y = self._func_dict['sample'](theta, d, num_samples, rng)
+        with profiling._timer('likelihood.sample'):
+            y = self._func_dict['sample'](theta, d, num_samples, rng)
         return y.reshape(num_samples, y.shape[-1])
 
     @staticmethod
@@ -59,15 +64,45 @@ class Likelihood(Distribution):
         return epsilon.reshape(num_samples, epsilon.shape[-1])
 
     def logpdf(self, y, theta, d, return_logpdf=True, return_dy=True, return_dt=False, return_dd=False, return_dt_dt=False, return_dt_dd=False, return_dt_dy=False):
+        num_samples, theta, d, y = utils._compact_shared_inputs(theta=theta, d=d, y=y)
         theta, d, y = utils._preprocess_inputs(theta=theta, d=d, y=y)
-        outputs = \
-        self._func_dict['logpdf_and_grads'](y, theta, d, return_logpdf, return_dy, return_dt, return_dd, return_dt_dt, return_dt_dd, return_dt_dy)
-        return self._reshape_logpdf_outputs(outputs, theta, d)
+        with profiling._timer('likelihood.logpdf'):
+            outputs = \
+            self._func_dict['logpdf_and_grads'](y, theta, d, return_logpdf, return_dy, return_dt, return_dd, return_dt_dt, return_dt_dd, return_dt_dy)
+        outputs = self._reshape_logpdf_outputs(outputs, theta, d)
+        return self._broadcast_outputs(outputs, num_samples)
 
     def transform(self, epsilon, theta, d, return_dd=False):
+        num_samples, epsilon, theta, d = utils._compact_shared_inputs(epsilon=epsilon, theta=theta, d=d)
         epsilon, theta, d = utils._preprocess_inputs(epsilon=epsilon, theta=theta, d=d)
-        outputs = self._func_dict['transform_and_grads'](epsilon, theta, d, return_dd)
-        return self._reshape_transform_outputs(outputs, d)
+        with profiling._timer('likelihood.transform'):
+            outputs = self._func_dict['transform_and_grads'](epsilon, theta, d, return_dd)
+        outputs = self._reshape_transform_outputs(outputs, d)
+        return self._broadcast_outputs(outputs, num_samples)
+
+    @property
+    def has_closed_form_fisher_information(self):
+        return self._func_dict['fisher_info_and_grads'] is not None
+
+    def fisher_information(self, theta, d, return_dd=False):
+        if not self.has_closed_form_fisher_information:
+            raise AttributeError('Closed-form Fisher information function not specified.')
+        num_samples, theta, d = utils._compact_shared_inputs(theta=theta, d=d)
+        theta, d = utils._preprocess_inputs(theta=theta, d=d)
+        with profiling._timer('likelihood.fisher_information'):
+            outputs = self._func_dict['fisher_info_and_grads'](theta, d, return_dd)
+        outputs = self._reshape_fisher_info_outputs(outputs, theta, d)
+        return self._broadcast_outputs(outputs, num_samples)
+
+    @staticmethod
+    def _reshape_fisher_info_outputs(outputs, theta, d):
+        (num_batch, theta_dim), d_dim = theta.shape, d.shape[-1]
+        for key, val in outputs.items():
+            if key == 'fisher_info':
+                outputs[key] = val.reshape(num_batch, theta_dim, theta_dim)
+            elif key == 'fisher_info_dd':
+                outputs[key] = val.reshape(num_batch, theta_dim, theta_dim, d_dim)
+        return outputs
 
     @staticmethod
     def _reshape_transform_outputs(outputs, d):
@@ -122,24 +157,35 @@ class Likelihood(Distribution):
             if return_logpdf:
                 outputs['logpdf'] = utils.gaussian_logpdf(y, mean=y_pred, cov=noise_cov, icov=noise_icov)
             if return_dy:
-                outputs['logpdf_dy'] = -0.5*np.einsum('ij,aj->ai', noise_icov + noise_icov.T, y-y_pred)
+                outputs['logpdf_dy'] = -0.5*utils._einsum('ij,aj->ai', noise_icov + noise_icov.T, y-y_pred)
             if return_dt:
-                outputs['logpdf_dt'] = 0.5*np.einsum('ij,aj,aik->ak', noise_icov + noise_icov.T, y-y_pred, y_pred_dt)
+                outputs['logpdf_dt'] = 0.5*utils._einsum('ij,aj,aik->ak', noise_icov + noise_icov.T, y-y_pred, y_pred_dt)
             if return_dd:
-                outputs['logpdf_dd'] = 0.5*np.einsum('ij,aj,aik->ak', noise_icov + noise_icov.T, y-y_pred, y_pred_dd)
+                outputs['logpdf_dd'] = 0.5*utils._einsum('ij,aj,aik->ak', noise_icov + noise_icov.T, y-y_pred, y_pred_dd)
             if return_dt_dt:
                 outputs['logpdf_dt_dt'] = \
-                0.5*(np.einsum('aijl,ik,ak->ajl', y_pred_dt_dt, noise_icov + noise_icov.T, y-y_pred) - \
-                     np.einsum('aij,ik,akl->ajl', y_pred_dt, noise_icov + noise_icov.T, y_pred_dt))
+                0.5*(utils._einsum('aijl,ik,ak->ajl', y_pred_dt_dt, noise_icov + noise_icov.T, y-y_pred) - \
+                     utils._einsum('aij,ik,akl->ajl', y_pred_dt, noise_icov + noise_icov.T, y_pred_dt))
             if return_dt_dd:
                 outputs['logpdf_dt_dd'] = \
-                0.5*(np.einsum('aijl,ik,ak->ajl', y_pred_dt_dd, noise_icov + noise_icov.T, y-y_pred) - \
-                     np.einsum('aij,ik,akl->ajl', y_pred_dt, noise_icov + noise_icov.T, y_pred_dd))
+                0.5*(utils._einsum('aijl,ik,ak->ajl', y_pred_dt_dd, noise_icov + noise_icov.T, y-y_pred) - \
+                     utils._einsum('aij,ik,akl->ajl', y_pred_dt, noise_icov + noise_icov.T, y_pred_dd))
             if return_dt_dy:
-                outputs['logpdf_dt_dy'] = 0.5*np.einsum('im,aik->akm', noise_icov + noise_icov.T, y_pred_dt)
+                outputs['logpdf_dt_dy'] = 0.5*utils._einsum('im,aik->akm', noise_icov + noise_icov.T, y_pred_dt)
+            return outputs
+
+        def fisher_info_and_grads(theta, d, return_dd):
+            # For y ~ N(g(theta, d), noise_cov), the Fisher information is exactly g_dt^T @ noise_icov @ g_dt:
+            y_pred_dt = model.predict_dt(theta, d)
+            outputs = {'fisher_info': utils._einsum('aki,kl,alj->aij', y_pred_dt, noise_icov, y_pred_dt)}
+            if return_dd:
+                y_pred_dt_dd = model.predict_dt_dd(theta, d)
+                outputs['fisher_info_dd'] = utils._einsum('akim,kl,alj->aijm', y_pred_dt_dd, noise_icov, y_pred_dt) + \
+                                            utils._einsum('aki,kl,aljm->aijm', y_pred_dt, noise_icov, y_pred_dt_dd)
             return outputs
 
-        return cls(sample=sample, sample_base=sample_base, logpdf_and_grads=logpdf_and_grads, transform_and_grads=transform_and_grads)
+        return cls(sample=sample, sample_base=sample_base, logpdf_and_grads=logpdf_and_grads, transform_and_grads=transform_and_grads,
+                   fisher_info_and_grads=fisher_info_and_grads)
 
     def _create_logpdf_and_grads(self, logpdf, logpdf_dy, logpdf_dt, logpdf_dd, logpdf_dt_dt, logpdf_dt_dd, logpdf_dt_dt_dd):
         def logpdf_and_grads(y, theta, d, return_logpdf, return_dy, return_dt, return_dd, return_dt_dt, return_dt_dd, return_dt_dy):
@@ -172,19 +218,37 @@ class Likelihood(Distribution):
 
 class Prior(Distribution):
     
-    def __init__(self, sample=None, logpdf=None, logpdf_dt=None, logpdf_and_grads=None):
+    def __init__(self, sample=None, logpdf=None, logpdf_dt=None, logpdf_and_grads=None, sample_base=None, transform=None):
         if logpdf_and_grads is None:
             logpdf_and_grads = self._create_logpdf_and_grads(logpdf, logpdf_dt)
-        self._func_dict = {'sample': sample, 'logpdf_and_grads': logpdf_and_grads}
+        self._func_dict = {'sample': sample, 'logpdf_and_grads': logpdf_and_grads, 'sample_base': sample_base, 'transform': transform}
 
     def sample(self, num_samples, rng=None):
-        theta = self._func_dict['sample'](num_samples, rng).reshape(num_samples,-1)
+        with profiling._timer('prior.sample'):
+            theta = self._func_dict['sample'](num_samples, rng).reshape(num_samples,-1)
         return theta.reshape(num_samples, theta.shape[-1])
 
+    def sample_base(self, num_samples, rng=None):
+        if self._func_dict['sample_base'] is None:
+            raise AttributeError('Base distribution sampling function not specified.')
+        epsilon = self._func_dict['sample_base'](num_samples, rng)
+        return epsilon.reshape(num_samples, epsilon.shape[-1])
+
+    def transform(self, epsilon):
+        # Maps samples of the base distribution to samples of the prior:
+        if self._func_dict['transform'] is None:
+            raise AttributeError('Transform function not specified.')
+        epsilon = utils._preprocess_inputs(epsilon=epsilon)
+        with profiling._timer('prior.transform'):
+            theta = self._func_dict['transform'](epsilon)
+        return theta.reshape(epsilon.shape[0], theta.shape[-1])
+
     def logpdf(self, theta, return_logpdf=True, return_dt=False):
+        num_samples, theta = utils._compact_shared_inputs(theta=theta)
         theta = utils._preprocess_inputs(theta=theta)
         outputs =  self._func_dict['logpdf_and_grads'](theta, return_logpdf, return_dt)
-        return self._reshape_logpdf_outputs(outputs, theta)
+        outputs = self._reshape_logpdf_outputs(outputs, theta)
+        return self._broadcast_outputs(outputs, num_samples)
 
     def _create_logpdf_and_grads(self, logpdf, logpdf_dt):
         def logpdf_and_grads(theta, return_logpdf, return_dt):
@@ -207,15 +271,21 @@ class Prior(Distribution):
         def sample(num_samples, rng):
             return utils.gaussian_sample(num_samples, mean=prior_mean, cov_chol=prior_chol, rng=rng)
 
+        def sample_base(num_samples, rng):
+            return utils.unit_gaussian_sample(prior_mean.size, num_samples, rng)
+
+        def transform(epsilon):
+            return utils.gaussian_transform(epsilon, mean=prior_mean, cov_chol=prior_chol)
+
         def logpdf_and_grads(theta, return_logpdf, return_dt):
             outputs = {}
             if return_logpdf:
                 outputs['logpdf'] = utils.gaussian_logpdf(theta, mean=prior_mean, cov=prior_cov, icov=prior_icov)
             if return_dt:
-                outputs['logpdf_dt'] = 2*np.einsum('ij,aj->ai', prior_icov, theta-prior_mean)
+                outputs['logpdf_dt'] = 2*utils._einsum('ij,aj->ai', prior_icov, theta-prior_mean)
             return outputs
 
-        return cls(sample=sample, logpdf_and_grads=logpdf_and_grads)
+        return cls(sample=sample, logpdf_and_grads=logpdf_and_grads, sample_base=sample_base, transform=transform)
 
 class Posterior(Distribution):
 
@@ -225,9 +295,12 @@ class Posterior(Distribution):
         self._func_dict = {'logpdf_and_grads': logpdf_and_grads}
 
     def logpdf(self, theta, y, d, return_logpdf=True, return_dd=False, return_dy=False):
+        num_samples, theta, d, y = utils._compact_shared_inputs(theta=theta, d=d, y=y)
         theta, d, y = utils._preprocess_inputs(theta=theta, d=d, y=y)
-        outputs = self._func_dict['logpdf_and_grads'](theta, y, d, return_logpdf, return_dd, return_dy)
-        return self._reshape_logpdf_outputs(outputs, theta, d)
+        with profiling._timer('posterior.logpdf'):
+            outputs = self._func_dict['logpdf_and_grads'](theta, y, d, return_logpdf, return_dd, return_dy)
+        outputs = self._reshape_logpdf_outputs(outputs, theta, d)
+        return self._broadcast_outputs(outputs, num_samples)
 
     @staticmethod
     def _create_logpdf_and_grads(logpdf, logpdf_dd, logpdf_dy):
@@ -252,7 +325,8 @@ class Posterior(Distribution):
         return cls(logpdf=logpdf, logpdf_dd=logpdf_dd, logpdf_dy=logpdf_dy)
 
     @classmethod
-    def from_jax_function(cls, jax_func, use_vmap=True, use_fwd=True):
+    def from_jax_function(cls, jax_func, use_vmap=True, use_fwd=True, cache=None, cache_key=None):
+        import jax
         if use_fwd:
             grad = jax.jacfwd
         else:
@@ -263,6 +337,12 @@ class Posterior(Distribution):
         if use_vmap:
             for key, func in func_dict.items():
                 func_dict[key] = jax.vmap(func, in_axes=(0,0,0))
+        # Load previously exported and compiled functions from cache:
+        if cache is not None:
+            if cache_key is None:
+                cache_key = compilation._function_key(jax_func)
+            for key, func in func_dict.items():
+                func_dict[key] = cache.wrap(func, key=f'{cache_key}-{key}')
         return cls(**func_dict)
 
     @classmethod
@@ -291,22 +371,33 @@ class Posterior(Distribution):
                 t_dim = cov.shape[0]
                 outputs['logpdf'] = utils.gaussian_logpdf(theta, mean, cov, icov) 
             if return_dd or return_dy:
-                g_dt_dt_map = model.predict_dt_dt(t_map, d)
+                # Second-order model derivatives only appear contracted with the noise-weighted residual
+                # or with derivatives of theta_map, so are computed as contractions rather than dense tensors:
+                v_map = utils._einsum('lk,ak->al', noise_icov, y-g_map)
+                g_dt_dt_v_map = models._contract(model, 'predict_dt_dt_vjp', t_map, d, v_map)
             if return_dd:
                 g_dd_map = model.predict_dd(t_map, d)
-                g_dt_dd_map = model.predict_dt_dd(t_map, d)
-                t_map_dd = theta_map_dd(y, g_map, g_dt_map, g_dd_map, g_dt_dt_map, g_dt_dd_map)
-                mean_dd, cov_dd, icov_dd = \
-                mean_cov_and_icov_dd(y, g_dt_map, g_dd_map, g_dt_dt_map, g_dt_dd_map, t_map, t_map_dd, cov, b)
-                outputs['logpdf_dd'] = -0.5*(np.einsum("aijk,aji->ak", cov_dd, icov) + \
-                                             np.einsum("aijk,ai,aj->ak", icov_dd, theta-mean, theta-mean) - \
-                                             2*np.einsum("alk,ali,ai->ak", mean_dd, icov, theta-mean))
+                g_dt_dd_v_map = models._contract(model, 'predict_dt_dd_vjp', t_map, d, v_map)
+                t_map_dd = theta_map_dd(g_dt_map, g_dd_map, g_dt_dt_v_map, g_dt_dd_v_map)
+                # G_dd = partial_d (partial_0 g(theta=theta_map(y,d), d)) = g_dt_dd + g_dt_dt @ t_map_dd:
+                d_dim = t_map_dd.shape[-1]
+                d_tangents = np.broadcast_to(np.identity(d_dim), (t_map_dd.shape[0], d_dim, d_dim))
+                G_dd = models._contract(model, 'predict_dt_jvp', t_map, d, t_map_dd, d_tangents)
+                with profiling._timer('posterior.mean_cov_and_icov_dd'):
+                    mean_dd, cov_dd, icov_dd = \
+                    mean_cov_and_icov_dd(y, g_dt_map, g_dd_map, G_dd, t_map, t_map_dd, cov, b)
+                outputs['logpdf_dd'] = -0.5*(utils._einsum("aijk,aji->ak", cov_dd, icov) + \
+                                             utils._einsum("aijk,ai,aj->ak", icov_dd, theta-mean, theta-mean) - \
+                                             2*utils._einsum("alk,ali,ai->ak", mean_dd, icov, theta-mean))
             if return_dy:
-                t_map_dy = theta_map_dy(y, g_map, g_dt_map, g_dt_dt_map)
-                mean_dy, cov_dy, icov_dy = mean_cov_and_icov_dy(y, g_dt_map, g_dt_dt_map, t_map, t_map_dy, cov, b)
-                outputs['logpdf_dy'] = -0.5*(np.einsum("aijk,aji->ak", cov_dy, icov) + \
-                                             np.einsum("ai,aijk,aj->ak", theta-mean, icov_dy, theta-mean) - \
-                                             2*np.einsum("aik,aij,aj->ak", mean_dy, icov, theta-mean))
+                t_map_dy = theta_map_dy(g_dt_map, g_dt_dt_v_map)
+                # G_dy = partial_y (partial_0 g(theta=theta_map(y,d), d)) = g_dt_dt @ t_map_dy:
+                G_dy = models._contract(model, 'predict_dt_jvp', t_map, d, t_map_dy)
+                with profiling._timer('posterior.mean_cov_and_icov_dy'):
+                    mean_dy, cov_dy, icov_dy = mean_cov_and_icov_dy(y, g_dt_map, G_dy, t_map, t_map_dy, cov, b)
+                outputs['logpdf_dy'] = -0.5*(utils._einsum("aijk,aji->ak", cov_dy, icov) + \
+                                             utils._einsum("ai,aijk,aj->ak", theta-mean, icov_dy, theta-mean) - \
+                                             2*utils._einsum("aik,aij,aj->ak", mean_dy, icov, theta-mean))
             return outputs        
 
         #
@@ -314,74 +405,73 @@ class Posterior(Distribution):
         #
 
         def theta_map(theta_0, y, d):
-            return minimizer(map_loss_and_grad, theta_0, args=(y, d))
+            with profiling._timer('posterior.theta_map'):
+                return minimizer(map_loss_and_grad, theta_0, args=(y, d))
 
         def map_loss_and_grad(theta, y, d):
+            profiling._count('posterior.map_iteration', theta.shape[0])
             y_pred = model.predict(theta, d)
             y_del_theta = model.predict_dt(theta, d)
-            loss = np.einsum("ai,ij,aj->a", y-y_pred, noise_icov, y-y_pred) + \
-                   np.einsum("ai,ij,aj->a", theta-prior_mean, prior_icov, theta-prior_mean)
-            loss_del_theta = -2*np.einsum("aik,ij,aj->ak", y_del_theta, noise_icov, y-y_pred) + \
-                              2*np.einsum("ij,aj->ai", prior_icov, theta-prior_mean)
+            loss = utils._einsum("ai,ij,aj->a", y-y_pred, noise_icov, y-y_pred) + \
+                   utils._einsum("ai,ij,aj->a", theta-prior_mean, prior_icov, theta-prior_mean)
+            loss_del_theta = -2*utils._einsum("aik,ij,aj->ak", y_del_theta, noise_icov, y-y_pred) + \
+                              2*utils._einsum("ij,aj->ai", prior_icov, theta-prior_mean)
             return loss, loss_del_theta
         
-        def map_loss_dt_dt(y, g_map, g_dt_map, g_dt_dt_map):
-            return 2*(prior_icov + np.einsum("ali,lk,akj->aij", g_dt_map, noise_icov, g_dt_map) \
-                     - np.einsum("alij,lk,ak->aij", g_dt_dt_map, noise_icov, y-g_map))   
-
-        def theta_map_dd(y, g_map, g_dt_map, g_dd_map, g_dt_dt_map, g_dt_dd_map):
-            loss_dt_dt = map_loss_dt_dt(y, g_map, g_dt_map, g_dt_dt_map)
-            loss_dt_dd = 2*(np.einsum("ali,lk,akj->aij", g_dt_map, noise_icov, g_dd_map) - \
-                            np.einsum("alij,lk,ak->aij", g_dt_dd_map, noise_icov, y-g_map))
+        # g_dt_dt_v_map = sum_l v_l * g_dt_dt_map[l] and g_dt_dd_v_map = sum_l v_l * g_dt_dd_map[l], where v = noise_icov @ (y - g_map):
+        def map_loss_dt_dt(g_dt_map, g_dt_dt_v_map):
+            return 2*(prior_icov + utils._einsum("ali,lk,akj->aij", g_dt_map, noise_icov, g_dt_map) - g_dt_dt_v_map)
+
+        def theta_map_dd(g_dt_map, g_dd_map, g_dt_dt_v_map, g_dt_dd_v_map):
+            loss_dt_dt = map_loss_dt_dt(g_dt_map, g_dt_dt_v_map)
+            loss_dt_dd = 2*(utils._einsum("ali,lk,akj->aij", g_dt_map, noise_icov, g_dd_map) - g_dt_dd_v_map)
             return -1*np.linalg.solve(loss_dt_dt, loss_dt_dd)
 
         def linearisation_constant(g_map, g_dt_map, theta_map):
-            return g_map - np.einsum("aij,aj->ai", g_dt_map, theta_map)
+            return g_map - utils._einsum("aij,aj->ai", g_dt_map, theta_map)
 
         def mean_cov_and_icov(y, theta_map, G, b):
             # G = partial_0 g(theta=theta_map(y,d), d) = g_dt_map
-            inv_cov = np.einsum("aki,kl,alj->aij", G, noise_icov, G) + prior_icov
+            inv_cov = utils._einsum("aki,kl,alj->aij", G, noise_icov, G) + prior_icov
             cov = np.linalg.inv(inv_cov)
-            mean_times_inv_cov = np.einsum("aj,jk,aki->ai", y-b, noise_icov, G) + np.einsum('i,ij->j', prior_mean, prior_icov)
-            mean = np.einsum("ak,aki->ai", mean_times_inv_cov, cov)
+            mean_times_inv_cov = utils._einsum("aj,jk,aki->ai", y-b, noise_icov, G) + utils._einsum('i,ij->j', prior_mean, prior_icov)
+            mean = utils._einsum("ak,aki->ai", mean_times_inv_cov, cov)
             return mean, cov, inv_cov
 
-        def mean_cov_and_icov_dd(y, G, g_dd_map, g_dt_dt_map, g_dt_dd_map, t_map, t_map_dd, cov, b):
+        def mean_cov_and_icov_dd(y, G, g_dd_map, G_dd, t_map, t_map_dd, cov, b):
             # G = partial_0 g(theta=theta_map(y,d), d) = g_dt_map
             # G_dd = partial_d (partial_0 g(theta=theta_map(y,d), d)):
-            G_dd = g_dt_dd_map + np.einsum('aij,akli->aklj', t_map_dd, g_dt_dt_map)
-            icov_dd = np.einsum("alik,lm,amj->aijk", G_dd, noise_icov, G) + \
-                      np.einsum("ali,lm,amjk->aijk", G, noise_icov, G_dd)
-            cov_dd = -1*np.einsum("ail,almk,amj->aijk", cov, icov_dd, cov)
-            b_dd = np.einsum("akj,aik->aij", t_map_dd, G) + g_dd_map - \
-                   np.einsum("aikj,ak->aij", G_dd, t_map) - \
-                   np.einsum("aik,akj->aij", G, t_map_dd)
-            mean_dd = np.einsum("akij,al,lm,amk->aij", cov_dd, y-b, noise_icov, G) -\
-                      np.einsum("aki,alj,lm,amk->aij", cov, b_dd, noise_icov, G) +\
-                      np.einsum("aki,al,lm,amkj->aij", cov, y-b, noise_icov, G_dd) +\
-                      np.einsum("l,lk,akij->aij", prior_mean, prior_icov, cov_dd)
+            icov_dd = utils._einsum("alik,lm,amj->aijk", G_dd, noise_icov, G) + \
+                      utils._einsum("ali,lm,amjk->aijk", G, noise_icov, G_dd)
+            cov_dd = -1*utils._einsum("ail,almk,amj->aijk", cov, icov_dd, cov)
+            b_dd = utils._einsum("akj,aik->aij", t_map_dd, G) + g_dd_map - \
+                   utils._einsum("aikj,ak->aij", G_dd, t_map) - \
+                   utils._einsum("aik,akj->aij", G, t_map_dd)
+            mean_dd = utils._einsum("akij,al,lm,amk->aij", cov_dd, y-b, noise_icov, G) -\
+                      utils._einsum("aki,alj,lm,amk->aij", cov, b_dd, noise_icov, G) +\
+                      utils._einsum("aki,al,lm,amkj->aij", cov, y-b, noise_icov, G_dd) +\
+                      utils._einsum("l,lk,akij->aij", prior_mean, prior_icov, cov_dd)
             return mean_dd, cov_dd, icov_dd
 
-        def theta_map_dy(y, g_map, g_dt_map, g_dt_dt_map):
-            loss_dt_dt = map_loss_dt_dt(y, g_map, g_dt_map, g_dt_dt_map)    
-            loss_dt_dy = -2*np.einsum('ik,akj->aij', noise_icov, g_dt_map)
+        def theta_map_dy(g_dt_map, g_dt_dt_v_map):
+            loss_dt_dt = map_loss_dt_dt(g_dt_map, g_dt_dt_v_map)    
+            loss_dt_dy = -2*utils._einsum('ik,akj->aij', noise_icov, g_dt_map)
             return -1*np.linalg.solve(loss_dt_dt, loss_dt_dy)
         
-        def mean_cov_and_icov_dy(y, G, g_dt_dt_map, t_map, t_map_dy, cov, b):
+        def mean_cov_and_icov_dy(y, G, G_dy, t_map, t_map_dy, cov, b):
             # G = partial_0 g(theta=theta_map(y,d), d) = g_dt_map
             # G_dy = partial_y (partial_0 g(theta=theta_map(y,d), d)):
-            G_dy = np.einsum('aij,akli->aklj', t_map_dy, g_dt_dt_map)
-            icov_dy = np.einsum("alik,lm,amj->aijk", G_dy, noise_icov, G) + \
-                      np.einsum("ali,lm,amjk->aijk", G, noise_icov, G_dy)
-            cov_dy = -1*np.einsum("ail,almk,amj->aijk", cov, icov_dy, cov)
-            b_dy = np.einsum("akj,aik->aij", t_map_dy, G) - \
-                   np.einsum("aikj,ak->aij", G_dy, t_map) - \
-                   np.einsum("aik,akj->aij", G, t_map_dy)
+            icov_dy = utils._einsum("alik,lm,amj->aijk", G_dy, noise_icov, G) + \
+                      utils._einsum("ali,lm,amjk->aijk", G, noise_icov, G_dy)
+            cov_dy = -1*utils._einsum("ail,almk,amj->aijk", cov, icov_dy, cov)
+            b_dy = utils._einsum("akj,aik->aij", t_map_dy, G) - \
+                   utils._einsum("aikj,ak->aij", G_dy, t_map) - \
+                   utils._einsum("aik,akj->aij", G, t_map_dy)
             y_minus_b_dy = np.identity(b_dy.shape[-1]) - b_dy
-            mean_dy = np.einsum("akij,al,lm,amk->aij", cov_dy, y-b, noise_icov, G) + \
-                      np.einsum("aki,alj,lm,amk->aij", cov, y_minus_b_dy, noise_icov, G) + \
-                      np.einsum("aki,al,lm,amkj->aij", cov, y-b, noise_icov, G_dy) + \
-                      np.einsum("l,lk,akij->aij", prior_mean, prior_icov, cov_dy)
+            mean_dy = utils._einsum("akij,al,lm,amk->aij", cov_dy, y-b, noise_icov, G) + \
+                      utils._einsum("aki,alj,lm,amk->aij", cov, y_minus_b_dy, noise_icov, G) + \
+                      utils._einsum("aki,al,lm,amkj->aij", cov, y-b, noise_icov, G_dy) + \
+                      utils._einsum("l,lk,akij->aij", prior_mean, prior_icov, cov_dy)
             return mean_dy, cov_dy, icov_dy
 
         return cls(logpdf_and_grads=logpdf_and_grads)
@@ -1,34 +1,120 @@
 import numpy as np
-from . import distributions, utils
+from . import distributions, profiling, utils
 
 #
 #   Approximate Posterior Entropy
 #
 
-class APE:
+class APE(utils._Estimator):
 
-    def __init__(self, prior, likelihood, posterior, use_reparameterisation=False):
+    def __init__(self, prior, likelihood, posterior, use_reparameterisation=False, num_pilot_samples=50, num_pilot_repeats=5, 
+                 recycle_samples=False, ess_threshold=0.5, low_fidelity=None, low_fidelity_ratio=10, quadrature_level=None, sparse_grid=False,
+                 return_quadrature_error=False):
+        # use_reparameterisation='auto' chooses between the score function and reparameterisation estimators 
+        # (with and without control variates) using a short pilot run - see select_estimator:
+        self._sample_loss_funcs = {False: self._create_loss(prior, likelihood, posterior)}
         if use_reparameterisation:
-            self._loss_and_grad = self._create_reparameterisation_loss(prior, likelihood, posterior)
-        else:
-            self._loss_and_grad = self._create_loss(prior, likelihood, posterior)
+            self._sample_loss_funcs[True] = self._create_reparameterisation_loss(prior, likelihood, posterior)
+        self._set_estimator_options(likelihood, num_pilot_samples, num_pilot_repeats, recycle_samples, ess_threshold, low_fidelity, 
+                                    low_fidelity_ratio, quadrature_level, sparse_grid, return_quadrature_error)
+        if (low_fidelity is not None) and not all(key in low_fidelity._sample_loss_funcs for key in self._sample_loss_funcs):
+            raise ValueError('low_fidelity loss must support the same estimators as this loss.')
+        self._prior = prior
+        self._auto_select = (use_reparameterisation == 'auto')
+        self._estimator = {'use_reparameterisation': use_reparameterisation is True, 'apply_control_variates': False}
+        if recycle_samples:
+            self._joint = distributions.Joint.from_prior_and_likelihood(prior, likelihood)
 
-    def __call__(self, d, num_samples=None, samples=None, rng=None, apply_control_variates=False, return_grad=True):
+    def __call__(self, d, num_samples=None, samples=None, rng=None, apply_control_variates=None, return_grad=True, pool=None, seed=None):
+        # num_samples, samples, rng, pool and seed are ignored if quadrature_level was specified:
+        if self._quadrature_level is not None:
+            return self._quadrature_loss(d, return_grad)
         if (num_samples is None) and (samples is None):
             raise ValueError('Must specify either num_samples or samples as an input.')
         if num_samples is None:
             # Get sample dimension of first element of samples dict:
             num_samples = list(samples.values())[0].shape[0]
+        if self._auto_select:
+            self.select_estimator(d, rng=rng)
+        use_reparameterisation = self._estimator['use_reparameterisation']
+        if apply_control_variates is None:
+            apply_control_variates = self._estimator['apply_control_variates']
+        if (self._low_fidelity is not None) and (apply_control_variates or (samples is not None)):
+            raise ValueError('Control variates and user-specified samples cannot be used with a low_fidelity loss.')
+        with profiling._timer('APE'):
+            if pool is not None:
+                stats = pool.map_shards('_loss_statistics', num_samples, samples, seed, rng, d=d, 
+                                        apply_control_variates=apply_control_variates, return_grad=return_grad,
+                                        use_reparameterisation=use_reparameterisation)
+            else:
+                stats = self._loss_statistics(d, num_samples, samples, rng, apply_control_variates, return_grad, use_reparameterisation)
+            outputs = {key: -1*utils._estimate_from_statistics(val) for key, val in stats.items()}
+        return outputs['loss'] if not return_grad else (outputs['loss'], outputs['loss_del_d'])
+
+    def _loss_statistics(self, d, num_samples, samples, rng, apply_control_variates, return_grad, use_reparameterisation):
+        if self._low_fidelity is not None:
+            return self._multi_fidelity_statistics(d, num_samples, rng, return_grad, use_reparameterisation)
+        weights = None
+        if (samples is None) and (self._recycler is not None) and (not use_reparameterisation):
+            samples, weights = self._recycler.get_samples(self._joint.sample, d, num_samples, rng)
         if samples is None:
             samples = {}
-        return self._loss_and_grad(d, num_samples, samples, rng, apply_control_variates, return_grad)
+        sample_loss_and_grad = self._sample_loss_funcs[use_reparameterisation]
+        outputs, like_grad = sample_loss_and_grad(d, num_samples, samples, rng, apply_control_variates, return_grad)
+        cv_list = [like_grad] if apply_control_variates else []
+        return {key: utils._sample_statistics(val, cv_list, weights) for key, val in outputs.items()}
+
+    def _multi_fidelity_statistics(self, d, num_samples, rng, return_grad, use_reparameterisation):
+        # Both fidelities share the same theta and noise samples, so that their losses are correlated:
+        num_lf_samples = max(int(np.ceil(self._low_fidelity_ratio*num_samples)), num_samples)
+        theta = self._prior.sample(num_lf_samples, rng)
+        epsilon = self._likelihood.sample_base(num_lf_samples, rng)
+        hf_outputs = self._outputs_from_base_samples(d, theta[:num_samples], epsilon[:num_samples], return_grad, use_reparameterisation)
+        lf_outputs = self._low_fidelity._outputs_from_base_samples(d, theta, epsilon, return_grad, use_reparameterisation)
+        return {key: utils._multi_fidelity_statistics(val, lf_outputs[key]) for key, val in hf_outputs.items()}
+
+    def _outputs_from_base_samples(self, d, theta, epsilon, return_grad, use_reparameterisation):
+        if use_reparameterisation:
+            samples = {'theta': theta, 'epsilon': epsilon}
+        else:
+            samples = {'theta': theta, 'y': self._likelihood.transform(epsilon, theta, d)['y']}
+        outputs, _ = self._sample_loss_funcs[use_reparameterisation](d, theta.shape[0], samples, None, False, return_grad)
+        return outputs
+
+    def _quadrature_loss(self, d, return_grad):
+        use_reparameterisation = self._estimator['use_reparameterisation']
+        def estimate(nodes, weights):
+            theta_nodes, epsilon_nodes = nodes
+            outputs = self._outputs_from_base_samples(d, self._prior.transform(theta_nodes), epsilon_nodes, return_grad, use_reparameterisation)
+            return {key: -1*utils._estimate_from_statistics(utils._sample_statistics(val, weights=weights)) for key, val in outputs.items()}
+        with profiling._timer('APE'):
+            outputs, errors = self._quadrature_estimate(estimate, self._prior, self._likelihood)
+        loss_and_grad = (outputs['loss'],) if not return_grad else (outputs['loss'], outputs['loss_del_d'])
+        if errors is not None:
+            loss_and_grad = (*loss_and_grad, errors)
+        return loss_and_grad if len(loss_and_grad) > 1 else loss_and_grad[0]
+
+    def select_estimator(self, d, num_samples=None, num_repeats=None, rng=None):
+        # Control variates can't be combined with a low fidelity loss:
+        cv_options = (False, True) if self._low_fidelity is None else (False,)
+        candidates = [{'use_reparameterisation': use_reparameterisation, 'apply_control_variates': apply_control_variates}
+                      for use_reparameterisation in self._sample_loss_funcs for apply_control_variates in cv_options]
+        def pilot_grad(candidate, num_samples):
+            # Pilot always uses freshly drawn samples (i.e. not recycled ones):
+            stats = self._loss_statistics(d, num_samples, {}, rng, candidate['apply_control_variates'], True, candidate['use_reparameterisation'])
+            return utils._estimate_from_statistics(stats['loss_del_d'])
+        return self._select_estimator(candidates, pilot_grad, num_samples, num_repeats)
 
     @classmethod
-    def using_laplace_approximation(cls, model, minimizer, prior_mean, prior_cov, noise_cov, use_reparameterisation=False):
+    def using_laplace_approximation(cls, model, minimizer, prior_mean, prior_cov, noise_cov, use_reparameterisation=False, 
+                                    low_fidelity_model=None, low_fidelity_ratio=10):
         prior = distributions.Prior.gaussian(prior_mean, prior_cov)
         likelihood = distributions.Likelihood.from_model_plus_constant_gaussian_noise(model, noise_cov)
         approx_posterior = distributions.Posterior.laplace_approximation(model, minimizer, noise_cov, prior_mean, prior_cov)
-        return cls(prior, likelihood, approx_posterior, use_reparameterisation)
+        low_fidelity = None
+        if low_fidelity_model is not None:
+            low_fidelity = cls.using_laplace_approximation(low_fidelity_model, minimizer, prior_mean, prior_cov, noise_cov, use_reparameterisation)
+        return cls(prior, likelihood, approx_posterior, use_reparameterisation, low_fidelity=low_fidelity, low_fidelity_ratio=low_fidelity_ratio)
 
     def _create_reparameterisation_loss(self, prior, likelihood, posterior):
         
@@ -52,8 +138,7 @@ class APE:
                 like_grad = likelihood.logpdf(transform['y'], theta, d, return_logpdf=False, return_dd=True)['logpdf_dd']
             else:
                 like_grad = None
-            outputs = self._average_samples(outputs, like_grad, apply_control_variates)
-            return outputs['loss'] if not return_grad else (outputs['loss'], outputs['loss_del_d'])
+            return outputs, like_grad
 
         return ape_and_grad
 
@@ -72,23 +157,15 @@ class APE:
             post_vals = posterior.logpdf(theta, y, d, return_dd=return_grad)
             outputs['loss'] = post_vals['logpdf']
             # Need to compute like_grad if we're applying control variates:
+            like_grad = None
             if return_grad or apply_control_variates:
                 like_grad = likelihood.logpdf(y, theta, d, return_logpdf=False, return_dd=True)['logpdf_dd']
             if return_grad:
                 outputs['loss_del_d'] = np.einsum('a,ai->ai', post_vals['logpdf'], like_grad) + post_vals['logpdf_dd']
-            outputs = self._average_samples(outputs, like_grad, apply_control_variates)
-            return outputs['loss'] if not return_grad else (outputs['loss'], outputs['loss_del_d'])
+            return outputs, like_grad
 
         return ape_and_grad
 
-    @staticmethod
-    def _average_samples(outputs, like_grad, apply_control_variates):
-        for key, val in outputs.items():
-            if apply_control_variates:
-                outputs[key] = -1*utils.apply_control_variates(val, cv=like_grad)
-            else:
-                outputs[key] = -1*np.mean(val, axis=0)
-        return outputs
 #
 #   'Alphabet' Optimal Criteria
 #
@@ -96,10 +173,17 @@ class APE:
 class _Alphabet:
     
     def __init__(self, cov_func):
+        self._cov_func = cov_func
         self._loss_and_grad = self._create_loss_and_grad(cov_func)
 
-    def __call__(self, d, theta_estimate, num_samples, rng=None, return_grad=True):
-        return self._loss_and_grad(d, theta_estimate, num_samples, rng, return_grad)
+    def select_estimator(self, d, theta_estimate, rng=None):
+        return self._cov_func.select_estimator(d, theta_estimate, rng=rng)
+
+    def __call__(self, d, theta_estimate, num_samples=None, rng=None, return_grad=True):
+        # If theta_estimate.shape = (num_estimates, theta_dim), the (pseudo-Bayesian) criterion and its gradient
+        # are averaged over all of the theta estimates:
+        with profiling._timer(type(self).__name__):
+            return self._loss_and_grad(d, theta_estimate, num_samples, rng, return_grad)
 
 class D_Optimal(_Alphabet):
 
@@ -107,14 +191,15 @@ class D_Optimal(_Alphabet):
     def _create_loss_and_grad(cov_func):
         def loss_and_grad(d, theta_estimate, num_samples, rng, return_grad):
             cov_vals = cov_func(d, theta_estimate, num_samples, rng, return_dd=return_grad)
-            cov = cov_vals['cov']
-            loss = -1*np.linalg.det(cov)
+            cov, cov_dd = _stack_covariances(cov_vals, return_grad)
+            # Pseudo-Bayesian criteria are averaged over the batch of theta estimates:
+            dets = -1*np.linalg.det(cov)
+            loss = np.mean(dets)
             if return_grad:
                 # Derivative of det(M) wrt M - see Eqn (49) in Matrix Cookbook (https://www2.imm.dtu.dk/pubdb/edoc/imm3274.pdf):
-                cov_dd = cov_vals['cov_dd']
-                loss_del_cov = loss*np.linalg.inv(cov).T
-                loss_del_d = np.einsum('ij,ijk->k', loss_del_cov, cov_dd)
-            return loss if not return_grad else loss, loss_del_d
+                loss_del_cov = np.einsum('b,bji->bij', dets, np.linalg.inv(cov))
+                loss_del_d = np.einsum('bij,bijk->k', loss_del_cov, cov_dd)/cov.shape[0]
+            return loss if not return_grad else (loss, loss_del_d)
         return loss_and_grad
 
 class A_Optimal(_Alphabet):
@@ -123,32 +208,59 @@ class A_Optimal(_Alphabet):
     def _create_loss_and_grad(cov_func):
         def loss_and_grad(d, theta_estimate, num_samples, rng, return_grad):
             cov_vals = cov_func(d, theta_estimate, num_samples, rng, return_dd=return_grad)
-            cov = cov_vals['cov']
+            cov, cov_dd = _stack_covariances(cov_vals, return_grad)
             inv_cov = np.linalg.inv(cov)
-            loss = -1*np.trace(cov)
+            loss = -1*np.mean(np.trace(cov, axis1=-2, axis2=-1))
             if return_grad:
                 # Derivative of tr(M^-1) wrt M = -((M^-1)^T)@((M^-1)^T) - substitute A = B = I into Eqn (124) in Matrix Cookbook:
-                cov_dd = cov_vals['cov_dd']
-                loss_del_cov = -1*np.einsum('ji,kj->ik', inv_cov, inv_cov)
+                loss_del_cov = -1*np.einsum('bji,bkj->bik', inv_cov, inv_cov)
                 # Want to MAXIMISE trace of inverse cov:
-                loss_del_d = -1*np.einsum('ij,ijk->k', loss_del_cov, cov_dd)
-            return loss if not return_grad else loss, loss_del_d
+                loss_del_d = -1*np.einsum('bij,bijk->k', loss_del_cov, cov_dd)/cov.shape[0]
+            return loss if not return_grad else (loss, loss_del_d)
         return loss_and_grad
 
 class E_Optimal(_Alphabet):
 
-    @staticmethod
-    def _create_loss_and_grad(cov_func):
+    # Need to MAXIMISE the smallest eigenvalue:
+    _largest = False
+
+    def __init__(self, cov_func, block_size=2, dense_threshold=128, degeneracy_tol=1e-6, tol=1e-8, maxiter=100):
+        # Eigenpairs of matrices with fewer than dense_threshold rows are found with a dense decomposition; 
+        # otherwise, block_size extreme eigenpairs are found iteratively, warm-started from the previous call:
+        self._eig_options = {'block_size': block_size, 'dense_threshold': dense_threshold, 'tol': tol, 'maxiter': maxiter}
+        self._degeneracy_tol = degeneracy_tol
+        super().__init__(cov_func)
+
+    def _create_loss_and_grad(self, cov_func):
+        state = {'eigvecs': None}
+        sign = 1 if self._largest else -1
         def loss_and_grad(d, theta_estimate, num_samples, rng, return_grad):
             cov_vals = cov_func(d, theta_estimate, num_samples, rng, return_dd=return_grad)
-            cov = cov_vals['cov']
-            eigvals, eigvecs = np.linalg.eigh(cov)
-            loss, min_eigvec = -1*eigvals[0], eigvecs[:,0]
+            cov, cov_dd = _stack_covariances(cov_vals, return_grad)
+            eigvals, eigvecs = utils._extreme_eigenpairs(cov, self._largest, state['eigvecs'], **self._eig_options)
+            state['eigvecs'] = eigvecs
+            loss = sign*np.mean(eigvals[:,0])
             if return_grad:
                 # Derivative of eigenvalue wrt matrix - see https://math.stackexchange.com/questions/2588473/derivatives-of-eigenvalues
-                cov_dd = cov_vals['cov_dd']
-                loss_del_cov = np.einsum('i,j->ij', min_eigvec, min_eigvec)
-                # Need to MAXIMISE the smallest eigenvalue:
-                loss_del_d = -1*np.einsum('ij,ijk->k', loss_del_cov, cov_dd)
-            return loss if not return_grad else loss, loss_del_d
+                # If the extreme eigenvalue is (nearly) degenerate, average over the eigenvectors of the degenerate cluster:
+                cluster = np.abs(eigvals - eigvals[:,:1]) <= self._degeneracy_tol*np.maximum(np.abs(eigvals[:,:1]), np.finfo(float).tiny)
+                loss_del_cov = np.einsum('bik,bjk->bij', eigvecs*cluster[:,None,:], eigvecs)/np.sum(cluster, axis=-1)[:,None,None]
+                loss_del_d = sign*np.einsum('bij,bijk->k', loss_del_cov, cov_dd)/cov.shape[0]
+            return loss if not return_grad else (loss, loss_del_d)
         return loss_and_grad
+
+class E_Optimal_Largest(E_Optimal):
+
+    # Need to MINIMISE the largest eigenvalue (e.g. of a predictive covariance):
+    _largest = True
+
+#
+#   Helper Functions
+#
+
+def _stack_covariances(cov_vals, return_grad):
+    # Covariances computed for a single theta estimate are treated as a batch of one:
+    dim = cov_vals['cov'].shape[-1]
+    cov = cov_vals['cov'].reshape(-1, dim, dim)
+    cov_dd = cov_vals['cov_dd'].reshape(*cov.shape, -1) if return_grad else None
+    return cov, cov_dd
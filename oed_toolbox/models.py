@@ -1,7 +1,6 @@
+import os
 import numpy as np
-import jax
-import jax.numpy as jnp
-from . import utils
+from . import compilation, profiling, utils
 
 class Model:
 
@@ -10,7 +9,12 @@ class Model:
         self._model_funcs = model_funcs
 
     @classmethod
-    def from_surrojax_gp(cls, surrojax_gp, create_x=None):
+    def from_surrojax_gp(cls, surrojax_gp, create_x=None, cache=None, cache_key=None):
+        import jax.numpy as jnp
+
+        # GP parameters are captured in a closure, so can't be used to identify compiled functions:
+        if (cache is not None) and (cache_key is None):
+            raise ValueError('Must specify cache_key when caching compiled surrojax_gp models.')
 
         append_x = lambda theta, d : jnp.concatenate([theta, d], axis=-1)
         if create_x is None:
@@ -22,10 +26,12 @@ class Model:
                 x = x[None,:]
             return surrojax_gp.predict(x, return_var=False)['mean']
 
-        return cls.from_jax_function(wrapped_surrojax_gp)
+        return cls.from_jax_function(wrapped_surrojax_gp, cache=cache, cache_key=cache_key)
 
     @classmethod
-    def from_jax_function(cls, jax_func, forward_mode=True):
+    def from_jax_function(cls, jax_func, forward_mode=True, cache=None, cache_key=None):
+        import jax
+        import jax.numpy as jnp
 
         # Differentiate:
         model_funcs = {'model': jax_func,
@@ -35,11 +41,39 @@ class Model:
                        'model_dt_dd': jax.jacfwd(jax.jacfwd(jax_func, argnums=0), argnums=1),
                        'model_dt_dt_dd': jax.jacfwd(jax.jacfwd(jax.jacfwd(jax_func, argnums=0), argnums=0), argnums=1)}
 
+        # Contractions of higher-order derivatives, which avoid forming dense (y_dim, theta_dim, ...) tensors:
+        def model_dt_dt_vjp(theta, d, v):
+            # Hessian of v^T g wrt theta (i.e. forward-over-reverse Hessian-vector products):
+            v_dot_model = lambda theta : jnp.dot(v, jax_func(theta, d).reshape(-1))
+            return jax.jacfwd(jax.grad(v_dot_model))(theta)
+
+        def model_dt_dd_vjp(theta, d, v):
+            v_dot_model_dt = lambda theta, d : jax.grad(lambda theta : jnp.dot(v, jax_func(theta, d).reshape(-1)))(theta)
+            return jax.jacfwd(v_dot_model_dt, argnums=1)(theta, d)
+
+        def model_dt_jvp(theta, d, theta_tangents, d_tangents):
+            # Directional derivatives of g_dt along each column of (theta_tangents, d_tangents):
+            model_dt = lambda theta, d : jax.jacfwd(jax_func, argnums=0)(theta, d).reshape(-1, theta.shape[-1])
+            jvp = lambda theta_dot, d_dot : jax.jvp(model_dt, (theta, d), (theta_dot, d_dot))[1]
+            return jax.vmap(jvp, in_axes=(1,1), out_axes=-1)(theta_tangents, d_tangents)
+
+        contraction_funcs = {'model_dt_dt_vjp': model_dt_dt_vjp, 
+                             'model_dt_dd_vjp': model_dt_dd_vjp, 
+                             'model_dt_jvp': model_dt_jvp}
+
         # Vectorise over sample dimensions and wrap functions:        
         def wrap_jax_func(func):
-            return lambda theta, d : func(jnp.array(theta, dtype=float), jnp.array(d, dtype=float))
+            return lambda *args : func(*[jnp.array(arg, dtype=float) for arg in args])
+        if (cache is not None) and (cache_key is None):
+            cache_key = compilation._function_key(jax_func)
+        model_funcs.update(contraction_funcs)
         for key, func in model_funcs.items():
-            model_funcs[key] = wrap_jax_func(jax.vmap(func, in_axes=(0,0)))
+            num_args = 4 if key == 'model_dt_jvp' else 3 if key in contraction_funcs else 2
+            func = jax.vmap(func, in_axes=num_args*(0,))
+            # Load previously exported and compiled functions from cache:
+            if cache is not None:
+                func = cache.wrap(func, key=f'{cache_key}-{key}')
+            model_funcs[key] = wrap_jax_func(func)
 
         return cls(use_jax=True, **model_funcs)
 
@@ -55,35 +89,232 @@ class Model:
         return cls(model=model, model_dt=model_dt, model_dd=model_dd, model_dt_dt=model_dt_dt,
                    model_dt_dd=model_dt_dd, model_dt_dt_dd=model_dt_dt_dd)
 
+    @classmethod
+    def from_precomputed_grid(cls, outputs, theta_points, d_points, scattered=False, spline_degree=3, smoothing=0., max_rbf_points=5000):
+        # Interpolates simulator outputs precomputed offline, so that predictions and their derivatives are cheap lookups.
+        # Tensor-product grid: theta_points and d_points are lists of 1D grid axes, and outputs.shape = (*grid_shape, y_dim);
+        # scattered grid: theta_points.shape = (num_points, theta_dim), d_points.shape = (num_points, d_dim) and
+        # outputs.shape = (num_points, y_dim). outputs may also be the path to a .npy file, which is memory-mapped. Note that 
+        # scattered grids are interpolated with dense radial basis functions, whose fitting requires O(num_points^2) memory and 
+        # O(num_points^3) time (and each lookup O(num_points) memory per point), so are limited to max_rbf_points points:
+        if isinstance(outputs, (str, os.PathLike)):
+            outputs = np.load(outputs, mmap_mode='r')
+        if scattered:
+            theta_dim = np.shape(theta_points)[-1] if np.ndim(theta_points) > 1 else 1
+            interpolant = _create_rbf_interpolant(outputs, theta_points, d_points, smoothing, max_rbf_points)
+        else:
+            theta_dim = len(theta_points)
+            interpolant = _create_spline_interpolant(outputs, theta_points, d_points, spline_degree)
+        return cls(**_create_interpolant_model_funcs(interpolant, theta_dim))
+
     def predict(self, theta, d):
-        theta, d = utils._preprocess_inputs(theta=theta, d=d, use_jax=self._use_jax)
-        num_samples = theta.shape[0]
-        return self._model_funcs['model'](theta, d).reshape(num_samples, -1)
+        return self._evaluate('predict', theta, d)
 
     def predict_dt(self, theta, d):
-        theta, d = utils._preprocess_inputs(theta=theta, d=d, use_jax=self._use_jax)
-        num_samples, theta_dim = theta.shape
-        return self._model_funcs['model_dt'](theta, d).reshape(num_samples, -1, theta_dim)
+        return self._evaluate('predict_dt', theta, d)
 
     def predict_dd(self, theta, d):
-        theta, d = utils._preprocess_inputs(theta=theta, d=d, use_jax=self._use_jax)
-        num_samples, d_dim = d.shape
-        return self._model_funcs['model_dd'](theta, d).reshape(num_samples, -1, d_dim)
+        return self._evaluate('predict_dd', theta, d)
 
     def predict_dt_dt(self, theta, d):
-        theta, d = utils._preprocess_inputs(theta=theta, d=d, use_jax=self._use_jax)
-        num_samples, theta_dim = theta.shape
-        return self._model_funcs['model_dt_dt'](theta, d).reshape(num_samples, -1, theta_dim, theta_dim)
+        return self._evaluate('predict_dt_dt', theta, d)
 
     def predict_dt_dd(self, theta, d):
+        return self._evaluate('predict_dt_dd', theta, d)
+
+    #
+    #   Derivative Contractions
+    #
+
+    def predict_dt_dt_vjp(self, theta, d, v):
+        # sum_k v_k * d^2 g_k/dtheta^2, shape = (num_samples, theta_dim, theta_dim):
+        if 'model_dt_dt_vjp' in self._model_funcs:
+            return self._evaluate('predict_dt_dt_vjp', theta, d, v)
+        return _dense_dt_dt_vjp(self, theta, d, v)
+
+    def predict_dt_dd_vjp(self, theta, d, v):
+        # sum_k v_k * d^2 g_k/dtheta dd, shape = (num_samples, theta_dim, d_dim):
+        if 'model_dt_dd_vjp' in self._model_funcs:
+            return self._evaluate('predict_dt_dd_vjp', theta, d, v)
+        return _dense_dt_dd_vjp(self, theta, d, v)
+
+    def predict_dt_jvp(self, theta, d, theta_tangents, d_tangents=None):
+        # Derivatives of g_dt along each of the num_tangents directions (theta_tangents[:,:,j], d_tangents[:,:,j]),
+        # shape = (num_samples, y_dim, theta_dim, num_tangents); d_tangents = None means zero tangents wrt d:
+        if 'model_dt_jvp' in self._model_funcs:
+            if d_tangents is None:
+                num_batch, num_tangents = np.shape(theta_tangents)[0], np.shape(theta_tangents)[-1]
+                d_tangents = np.zeros((num_batch, np.shape(np.atleast_1d(d))[-1], num_tangents))
+            return self._evaluate('predict_dt_jvp', theta, d, theta_tangents, d_tangents)
+        return _dense_dt_jvp(self, theta, d, theta_tangents, d_tangents)
+
+    # Output dimensions (after the batch dimension) of each prediction method:
+    _output_dims = {'predict': ('y',), 
+                    'predict_dt': ('y', 'theta'), 
+                    'predict_dd': ('y', 'd'), 
+                    'predict_dt_dt': ('y', 'theta', 'theta'), 
+                    'predict_dt_dd': ('y', 'theta', 'd'),
+                    'predict_dt_dt_vjp': ('theta', 'theta'),
+                    'predict_dt_dd_vjp': ('theta', 'd'),
+                    'predict_dt_jvp': ('y', 'theta', 'tangents')}
+
+    def _evaluate(self, method, theta, d, *args):
+        # If all inputs are shared across the batch, the model only needs to be evaluated once:
+        num_samples, theta, d, *args = \
+        utils._compact_shared_inputs(theta=theta, d=d, **{f'arg_{idx}': arg for idx, arg in enumerate(args)})
         theta, d = utils._preprocess_inputs(theta=theta, d=d, use_jax=self._use_jax)
-        (num_samples, theta_dim), d_dim = theta.shape, d.shape[-1]
-        return self._model_funcs['model_dt_dd'](theta, d).reshape(num_samples, -1, theta_dim, d_dim)
+        # Contraction vectors/tangents are batched along their first dimension:
+        num_rows = max([theta.shape[0], *[arg.shape[0] for arg in args]])
+        inputs = [np.broadcast_to(val, (num_rows, *val.shape[1:])) if val.shape[0] != num_rows else val for val in (theta, d, *args)]
+        dims = {'y': -1, 'theta': theta.shape[-1], 'd': d.shape[-1], 'tangents': args[-1].shape[-1] if args else None}
+        output_shape = (num_rows, *[dims[key] for key in self._output_dims[method]])
+        profiling._count(f'model.{method}', num_rows)
+        with profiling._timer(f'model.{method}'):
+            output = self._model_funcs[method.replace('predict', 'model')](*inputs).reshape(output_shape)
+        return utils._broadcast_batch(output, num_samples)
 
 #
 #   Helper Methods
 #
 
+def _contract(model, method, theta, d, *args):
+    # Models which don't provide derivative contractions (e.g. batching.MicroBatchedModel or other 
+    # duck-typed models) fall back on contracting dense second derivatives:
+    if hasattr(model, method):
+        return getattr(model, method)(theta, d, *args)
+    return _dense_contractions[method](model, theta, d, *args)
+
+def _dense_dt_dt_vjp(model, theta, d, v):
+    return np.einsum('ak,akij->aij', v, model.predict_dt_dt(theta, d))
+
+def _dense_dt_dd_vjp(model, theta, d, v):
+    return np.einsum('ak,akij->aij', v, model.predict_dt_dd(theta, d))
+
+def _dense_dt_jvp(model, theta, d, theta_tangents, d_tangents=None):
+    output = np.einsum('akli,aij->aklj', model.predict_dt_dt(theta, d), theta_tangents)
+    if d_tangents is not None:
+        output = output + np.einsum('aklm,amj->aklj', model.predict_dt_dd(theta, d), d_tangents)
+    return output
+
+_dense_contractions = {'predict_dt_dt_vjp': _dense_dt_dt_vjp, 
+                       'predict_dt_dd_vjp': _dense_dt_dd_vjp, 
+                       'predict_dt_jvp': _dense_dt_jvp}
+
+def _create_interpolant_model_funcs(interpolant, theta_dim):
+    # interpolant(x, nu) returns the derivative of the interpolated outputs of order nu[i] wrt x[:,i], where x = [theta, d]:
+    def derivative(theta, d, idx):
+        x = np.concatenate([theta, d], axis=-1)
+        nu = np.zeros(x.shape[-1], dtype=int)
+        for i in idx:
+            nu[i] += 1
+        return interpolant(x, nu)
+
+    def model(theta, d):
+        return derivative(theta, d, ())
+
+    def model_dt(theta, d):
+        return np.stack([derivative(theta, d, (i,)) for i in range(theta_dim)], axis=-1)
+
+    def model_dd(theta, d):
+        d_dim = d.shape[-1]
+        return np.stack([derivative(theta, d, (theta_dim+j,)) for j in range(d_dim)], axis=-1)
+
+    def model_dt_dt(theta, d):
+        # Hessian is symmetric, so only compute upper triangle:
+        columns = {}
+        for i in range(theta_dim):
+            for j in range(i, theta_dim):
+                columns[i,j] = columns[j,i] = derivative(theta, d, (i,j))
+        return np.stack([np.stack([columns[i,j] for j in range(theta_dim)], axis=-1) for i in range(theta_dim)], axis=-2)
+
+    def model_dt_dd(theta, d):
+        d_dim = d.shape[-1]
+        return np.stack([np.stack([derivative(theta, d, (i, theta_dim+j)) for j in range(d_dim)], axis=-1) 
+                         for i in range(theta_dim)], axis=-2)
+
+    return {'model': model, 'model_dt': model_dt, 'model_dd': model_dd, 'model_dt_dt': model_dt_dt, 'model_dt_dd': model_dt_dd}
+
+def _create_spline_interpolant(outputs, theta_points, d_points, degree):
+    from scipy.interpolate import make_interp_spline
+    axes = [np.asarray(axis, dtype=float) for axis in (*theta_points, *d_points)]
+    grid_shape = tuple(axis.size for axis in axes)
+    coeffs = np.asarray(outputs, dtype=float).reshape(*grid_shape, -1)
+    # Tensor-product B-spline coefficients are found by interpolating along each grid axis in turn:
+    knots, degrees = [], []
+    for dim, axis in enumerate(axes):
+        k = min(degree, axis.size-1)
+        spline = make_interp_spline(axis, np.moveaxis(coeffs, dim, 0), k=k, axis=0)
+        coeffs = np.moveaxis(spline.c, 0, dim)
+        knots.append(spline.t)
+        degrees.append(k)
+    try:
+        from scipy.interpolate import NdBSpline
+    except ImportError:
+        # NdBSpline requires scipy >= 1.12:
+        return _create_tensor_product_spline(knots, coeffs, degrees)
+    spline = NdBSpline(tuple(knots), coeffs, tuple(degrees))
+    def interpolant(x, nu):
+        return spline(x, nu=nu)
+    return interpolant
+
+def _create_tensor_product_spline(knots, coeffs, degrees):
+    from scipy.interpolate import BSpline
+    # Spline whose coefficients are the identity evaluates every basis function along an axis at once:
+    bases = [BSpline(t, np.identity(t.size-k-1), k) for t, k in zip(knots, degrees)]
+    def interpolant(x, nu):
+        output = coeffs
+        for dim, basis in enumerate(bases):
+            basis_vals = basis(x[:,dim], nu=int(nu[dim])) # (num_points, num_basis)
+            output = np.einsum('bi,i...->b...', basis_vals, output) if dim == 0 else np.einsum('bi,bi...->b...', basis_vals, output)
+        return output # (num_points, output_dim)
+    return interpolant
+
+def _create_rbf_interpolant(outputs, theta_points, d_points, smoothing, max_points):
+    num_points = np.shape(outputs)[0]
+    if num_points > max_points:
+        raise ValueError(f'Scattered interpolation of {num_points} points requires a dense {num_points} x {num_points} system '
+                         f'(~{8*num_points**2/1e9:.1f} GB) - use a tensor-product grid, subsample the points or increase max_rbf_points.')
+    x = np.concatenate([np.asarray(theta_points, dtype=float).reshape(num_points, -1), 
+                        np.asarray(d_points, dtype=float).reshape(num_points, -1)], axis=-1)
+    y = np.asarray(outputs, dtype=float).reshape(num_points, -1)
+    # Rescale each input dimension so that the (isotropic) basis functions are sensible:
+    shift, scale = np.mean(x, axis=0), np.std(x, axis=0)
+    scale[scale == 0] = 1.
+    z = (x - shift)/scale
+    # Cubic polyharmonic spline phi(r) = r^3 plus a linear polynomial tail:
+    r = np.linalg.norm(z[:,None,:] - z[None,:,:], axis=-1)
+    poly = np.concatenate([np.ones((num_points, 1)), z], axis=-1)
+    num_poly = poly.shape[-1]
+    lhs = np.block([[r**3 + smoothing*np.identity(num_points), poly], [poly.T, np.zeros((num_poly, num_poly))]])
+    rhs = np.concatenate([y, np.zeros((num_poly, y.shape[-1]))], axis=0)
+    solution = np.linalg.solve(lhs, rhs)
+    rbf_coeffs, poly_coeffs = solution[:num_points], solution[num_points:]
+
+    def interpolant(x_new, nu):
+        idx = [i for i, order in enumerate(nu) for _ in range(order)]
+        z_new = (x_new - shift)/scale
+        diff = z_new[:,None,:] - z[None,:,:]
+        r = np.linalg.norm(diff, axis=-1)
+        if len(idx) == 0:
+            basis = r**3
+            output = basis @ rbf_coeffs + np.concatenate([np.ones((z_new.shape[0], 1)), z_new], axis=-1) @ poly_coeffs
+        elif len(idx) == 1:
+            # d(r^3)/dz_i = 3*r*(z_i - z_i'):
+            basis = 3*r*diff[:,:,idx[0]]
+            output = basis @ rbf_coeffs + poly_coeffs[1+idx[0]]
+        elif len(idx) == 2:
+            # d^2(r^3)/dz_i dz_j = 3*(r*delta_ij + (z_i - z_i')*(z_j - z_j')/r), which vanishes as r -> 0:
+            i, j = idx
+            with np.errstate(divide='ignore', invalid='ignore'):
+                basis = 3*np.where(r > 0, (i == j)*r + diff[:,:,i]*diff[:,:,j]/r, 0.)
+            output = basis @ rbf_coeffs
+        else:
+            raise ValueError('Only derivatives up to second order are available from RBF interpolants.')
+        # Chain rule for input rescaling:
+        return output/np.prod(scale[idx])
+    
+    return interpolant
+
 def _vectorise(func):
     def vectorised_func(theta, d):
         num_samples = theta.shape[0]
@@ -1,5 +1,4 @@
 import numpy as np
-import scipy
 from math import inf
 
 def gradient_descent_for_map(lr=1e-3, abs_tol=1e-5, rel_tol=1e-5, max_iter=50, lr_step=1e-1, max_attempts=5):
@@ -54,42 +53,128 @@ def gradient_descent_for_map(lr=1e-3, abs_tol=1e-5, rel_tol=1e-5, max_iter=50, l
 
     return gradient_descent
 
-def adam_for_oed_loss(lr=1e-1, beta_1=0.9, beta_2=0.999, eps=1e-8, max_iter=100):
+def adam_for_oed_loss(lr=1e-1, beta_1=0.9, beta_2=0.999, eps=1e-8, max_iter=100, reselect_every=None, sample_schedule=None, 
+                      patience=None, loss_smoothing=0.9, min_improvement=0., min_grad_to_noise=None, noise_smoothing=0.9, 
+                      num_candidates=5, final_num_samples=None, final_sample_factor=10, final_seed=0):
+    # sample_schedule(num_iter, num_samples, grad_mean, grad_sq_mean) returns the number of samples to use at the next 
+    # iteration - see geometric_sample_schedule and variance_triggered_sample_schedule. If patience is specified, 
+    # optimisation stops once the smoothed loss hasn't improved by more than min_improvement (or the gradient-to-noise
+    # ratio has been below min_grad_to_noise) for patience consecutive iterations. The gradient-to-noise ratio is estimated from 
+    # exponential averages of g and g^2 which share the same weight, noise_smoothing, since Adam's moment estimates use different
+    # weights (beta_1 and beta_2) and so don't give a consistent variance estimate. The num_candidates designs with the lowest 
+    # smoothed losses are finally re-evaluated on a shared set of final_num_samples samples which, if not specified, is 
+    # final_sample_factor times the largest number of samples used during optimisation:
     def adam(oed_loss, d_0, num_samples, rng, args=None, kwargs=None, verbose=False, return_history=False):
         if args is None:
             args = []
         if kwargs is None:
             kwargs = {}
         if return_history:
-            history = {'loss': [], 'd': []}
-        num_iter = 0
-        best_loss, best_d = inf, None
+            history = {'loss': [], 'smoothed_loss': [], 'd': [], 'num_samples': []}
+        num_iter = num_stalled = 0
+        loss_avg, best_smoothed_loss = 0, inf
+        # Designs with the lowest smoothed losses, as (smoothed_loss, d) pairs:
+        candidates = []
         m_tm1, v_tm1 = 0, 0
-        d = d_0
+        grad_avg, grad_sq_avg = 0, 0
+        d = np.array(d_0, dtype=float)
+        max_num_samples = num_samples
         while num_iter < max_iter:
+            # Periodically re-check which gradient estimator is most efficient near the current design:
+            if (reselect_every is not None) and (num_iter > 0) and (num_iter % reselect_every == 0):
+                oed_loss.select_estimator(d, *args, rng=rng)
             loss, grad = oed_loss(d, *args, num_samples=num_samples, rng=rng, **kwargs)
+            # Bias-corrected exponential average of noisy losses:
+            loss_avg = compute_exp_avg(new_val=loss, current_avg=loss_avg, wt=loss_smoothing)
+            smoothed_loss = apply_bias_correction(loss_avg, num_iter, wt=loss_smoothing)
             if return_history:
                 history['loss'].append(float(loss))
-                history['d'].append(float(d))
+                history['smoothed_loss'].append(float(smoothed_loss))
+                history['d'].append(np.copy(d))
+                history['num_samples'].append(num_samples)
+            candidates = update_candidates(candidates, smoothed_loss, d)
             m_t = compute_exp_avg(new_val=grad, current_avg=m_tm1, wt=beta_1)
             v_t = compute_exp_avg(new_val=grad**2, current_avg=v_tm1, wt=beta_2)
             m_t_tilde = apply_bias_correction(m_t, num_iter, wt=beta_1)
             v_t_tilde = apply_bias_correction(v_t, num_iter, wt=beta_2)
-            d -= lr*m_t_tilde/(v_t_tilde**0.5 + eps)
-            if loss < best_loss:
-                best_loss = loss
-                best_d = d
+            d = d - lr*m_t_tilde/(v_t_tilde**0.5 + eps)
             m_tm1, v_tm1 = m_t, v_t
+            grad_avg = compute_exp_avg(new_val=grad, current_avg=grad_avg, wt=noise_smoothing)
+            grad_sq_avg = compute_exp_avg(new_val=grad**2, current_avg=grad_sq_avg, wt=noise_smoothing)
+            grad_mean = apply_bias_correction(grad_avg, num_iter, wt=noise_smoothing)
+            grad_sq_mean = apply_bias_correction(grad_sq_avg, num_iter, wt=noise_smoothing)
             num_iter += 1
             if verbose:
                 _print_optimiser_progress(num_iter, loss, d)
+            # Check for stalled progress:
+            improved = smoothed_loss < best_smoothed_loss - min_improvement
+            best_smoothed_loss = min(best_smoothed_loss, smoothed_loss)
+            noisy = (min_grad_to_noise is not None) and (_grad_to_noise_ratio(grad_mean, grad_sq_mean) < min_grad_to_noise)
+            num_stalled = 0 if (improved and not noisy) else num_stalled + 1
+            if (patience is not None) and (num_stalled >= patience):
+                break
+            if sample_schedule is not None:
+                num_samples = sample_schedule(num_iter, num_samples, grad_mean, grad_sq_mean)
+                max_num_samples = num_samples if max_num_samples is None else max(max_num_samples, num_samples)
+        # Final design (which hasn't been evaluated yet) is also a candidate:
+        candidates.append((None, d))
+        best_d = select_best_candidate(oed_loss, candidates, max_num_samples, args, kwargs)
         return (best_d, history) if return_history else best_d
     def compute_exp_avg(new_val, current_avg, wt):
         return wt*current_avg + (1-wt)*new_val 
     def apply_bias_correction(new_avg, num_iter, wt):
         return new_avg/(1-wt**(num_iter+1))
+    def update_candidates(candidates, smoothed_loss, d):
+        candidates = sorted(candidates + [(smoothed_loss, np.copy(d))], key=lambda candidate : candidate[0])
+        return candidates[:max(num_candidates, 1)]
+    def select_best_candidate(oed_loss, candidates, max_num_samples, args, kwargs):
+        if len(candidates) == 1:
+            return candidates[0][1]
+        # Losses which don't require samples (e.g. closed-form or quadrature estimates) are called with num_samples=None:
+        if final_num_samples is not None:
+            num_samples = final_num_samples
+        else:
+            num_samples = None if max_num_samples is None else int(np.ceil(final_sample_factor*max_num_samples))
+        # Re-evaluate all candidates on the same (large) set of samples, so that they're compared on an equal footing:
+        final_losses = [oed_loss(d, *args, num_samples=num_samples, rng=np.random.default_rng(final_seed), return_grad=False, **kwargs)
+                        for _, d in candidates]
+        return candidates[int(np.argmin(final_losses))][1]
     return adam
 
+def geometric_sample_schedule(growth_factor=2., grow_every=10, max_num_samples=None):
+    # Multiplies the number of samples by growth_factor every grow_every iterations:
+    def schedule(num_iter, num_samples, grad_mean, grad_sq_mean):
+        if (num_samples is not None) and (num_iter % grow_every == 0):
+            num_samples = _grow_num_samples(num_samples, growth_factor, max_num_samples)
+        return num_samples
+    return schedule
+
+def variance_triggered_sample_schedule(growth_factor=2., min_grad_to_noise=1., cooldown=5, max_num_samples=None):
+    # Multiplies the number of samples by growth_factor whenever the gradient-to-noise ratio (estimated from the optimiser's 
+    # exponential averages of g and g^2) drops below min_grad_to_noise, i.e. once gradient noise dominates near a solution; the averages
+    # need cooldown iterations to reflect the new number of samples before the number of samples is increased again:
+    state = {'last_growth': 0}
+    def schedule(num_iter, num_samples, grad_mean, grad_sq_mean):
+        if num_iter < state['last_growth']:
+            # Schedule is being re-used for a new optimisation:
+            state['last_growth'] = 0
+        if (num_samples is not None) and (num_iter - state['last_growth'] >= cooldown) and \
+           (_grad_to_noise_ratio(grad_mean, grad_sq_mean) < min_grad_to_noise):
+            num_samples = _grow_num_samples(num_samples, growth_factor, max_num_samples)
+            state['last_growth'] = num_iter
+        return num_samples
+    return schedule
+
+def _grow_num_samples(num_samples, growth_factor, max_num_samples):
+    num_samples = int(np.ceil(growth_factor*num_samples))
+    return num_samples if max_num_samples is None else min(num_samples, max_num_samples)
+
+def _grad_to_noise_ratio(grad_mean, grad_sq_mean):
+    # ||E[g]||^2 / tr(Var[g]), using the exponential averages of g and g^2:
+    grad_var = np.sum(np.maximum(grad_sq_mean - grad_mean**2, 0))
+    grad_norm_sq = np.sum(grad_mean**2)
+    return grad_norm_sq/grad_var if grad_var > 0 else inf
+
 def _print_optimiser_progress(num_iter, loss, x):
     print(f'Iteration {num_iter}: Loss = {loss}, x = {x}')
 
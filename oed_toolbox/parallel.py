@@ -0,0 +1,77 @@
+import os
+import multiprocessing
+import numpy as np
+from . import utils
+
+class ShardPool:
+
+    def __init__(self, factory, num_workers=None, args=(), kwargs=None, mp_context=None):
+        # factory(*args, **kwargs) is called once inside each worker to construct the loss/covariance object
+        # which evaluates that worker's shards - any compiled model functions are therefore built once per worker.
+        # Unless the 'fork' start method is used, factory must be picklable (i.e. a module-level function):
+        if kwargs is None:
+            kwargs = {}
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        self.num_workers = num_workers
+        context = multiprocessing.get_context(mp_context)
+        self._pool = context.Pool(num_workers, initializer=_initialise_worker, initargs=(factory, args, kwargs))
+
+    def map_shards(self, method_name, num_samples, samples=None, seed=None, rng=None, **kwargs):
+        # Calls method_name of each worker's object on a shard of the samples, with an independent random stream 
+        # spawned from seed (or, if seed isn't specified, from rng), and merges the sample statistics returned by each shard:
+        if (seed is not None) and (rng is not None):
+            raise ValueError('Cannot specify both seed and rng.')
+        if rng is not None:
+            seed = rng.integers(2**63)
+        num_shards = min(self.num_workers, num_samples)
+        shard_sizes = _compute_shard_sizes(num_samples, num_shards)
+        shard_seeds = np.random.SeedSequence(seed).spawn(num_shards)
+        shard_samples = _split_samples(samples, shard_sizes)
+        tasks = [(method_name, seed_i, dict(kwargs, num_samples=size_i, samples=samples_i))
+                 for size_i, seed_i, samples_i in zip(shard_sizes, shard_seeds, shard_samples)]
+        shard_stats = self._pool.starmap(_evaluate_shard, tasks)
+        return {key: utils._merge_statistics([stats[key] for stats in shard_stats]) for key in shard_stats[0]}
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+#
+#   Helper Functions
+#
+
+def _compute_shard_sizes(num_samples, num_shards):
+    shard_sizes = np.full((num_shards,), num_samples//num_shards, dtype=int)
+    shard_sizes[:num_samples % num_shards] += 1
+    return [int(size) for size in shard_sizes]
+
+def _split_samples(samples, shard_sizes):
+    num_shards = len(shard_sizes)
+    split_idx = np.cumsum(shard_sizes)[:-1]
+    if samples is None:
+        return num_shards*[None]
+    if isinstance(samples, dict):
+        split_samples = {key: np.split(val, split_idx, axis=0) for key, val in samples.items()}
+        return [{key: val[idx] for key, val in split_samples.items()} for idx in range(num_shards)]
+    return np.split(samples, split_idx, axis=0)
+
+#
+#   Worker Functions
+#
+
+# Object constructed by factory in each worker process:
+_worker_state = {}
+
+def _initialise_worker(factory, args, kwargs):
+    _worker_state['obj'] = factory(*args, **kwargs)
+
+def _evaluate_shard(method_name, seed, kwargs):
+    rng = np.random.default_rng(seed)
+    return getattr(_worker_state['obj'], method_name)(rng=rng, **kwargs)
@@ -0,0 +1,72 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+#
+#   Statistics Container
+#
+
+class Stats:
+
+    def __init__(self):
+        self.calls = {}
+        self.rows = {}
+        self.times = {}
+
+    def count(self, key, num_rows=None):
+        self.calls[key] = self.calls.get(key, 0) + 1
+        if num_rows is not None:
+            self.rows[key] = self.rows.get(key, 0) + int(num_rows)
+
+    @contextmanager
+    def time(self, key):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            total, num_calls = self.times.get(key, (0., 0))
+            self.times[key] = (total + elapsed, num_calls + 1)
+
+    def reset(self):
+        self.calls, self.rows, self.times = {}, {}, {}
+
+    def to_dict(self):
+        return {'calls': dict(self.calls),
+                'rows': dict(self.rows),
+                'times': {key: {'total': total, 'calls': num_calls, 'mean': total/num_calls}
+                          for key, (total, num_calls) in self.times.items()}}
+
+    def to_json(self, **json_kwargs):
+        return json.dumps(self.to_dict(), **json_kwargs)
+
+#
+#   Profiling Context
+#
+
+# Only one Stats object collects at a time - when this is None, profiling hooks return immediately:
+_active_stats = None
+
+@contextmanager
+def profile(stats=None):
+    global _active_stats
+    if stats is None:
+        stats = Stats()
+    prev_stats = _active_stats
+    _active_stats = stats
+    try:
+        yield stats
+    finally:
+        _active_stats = prev_stats
+
+# Re-usable no-op context manager returned by _timer when profiling is disabled:
+_null_timer = nullcontext()
+
+def _count(key, num_rows=None):
+    if _active_stats is not None:
+        _active_stats.count(key, num_rows)
+
+def _timer(key):
+    if _active_stats is None:
+        return _null_timer
+    return _active_stats.time(key)
@@ -0,0 +1,66 @@
+from math import factorial
+import numpy as np
+
+# Quadrature rules, keyed by (ndim, level, sparse_grid):
+_rules = {}
+
+def quadrature_rule(ndim, level, sparse_grid=False):
+    # Returns nodes.shape = (num_nodes, ndim) and weights.shape = (num_nodes,) of a rule for expectations wrt N(0, I):
+    key = (ndim, level, sparse_grid)
+    if key not in _rules:
+        _rules[key] = smolyak_gauss_hermite(ndim, level) if sparse_grid else gauss_hermite(ndim, level)
+    return _rules[key]
+
+def gauss_hermite(ndim, level):
+    # Tensor-product rule with level Gauss-Hermite nodes along each dimension:
+    if level < 1:
+        raise ValueError('Quadrature level must be at least 1.')
+    return _tensor_product(ndim*[_gauss_hermite_1d(level)])
+
+def smolyak_gauss_hermite(ndim, level):
+    # Smolyak sparse grid built from 1D Gauss-Hermite rules with 2i-1 nodes (i = 1, 2, ...) - level = 1 is a single node at 
+    # zero, and the number of nodes grows polynomially (rather than exponentially) in ndim. Note that some weights are negative:
+    if level < 1:
+        raise ValueError('Quadrature level must be at least 1.')
+    max_sum = ndim + level - 1
+    combined = {}
+    for multi_idx in _multi_indices(ndim, max_sum):
+        idx_sum = sum(multi_idx)
+        if idx_sum < max(ndim, max_sum - ndim + 1):
+            continue
+        coeff = (-1)**(max_sum - idx_sum)*_binomial(ndim - 1, max_sum - idx_sum)
+        nodes, weights = _tensor_product([_gauss_hermite_1d(2*i - 1) for i in multi_idx])
+        # Combine weights of nodes shared between tensor-product rules (e.g. those at zero):
+        for node, weight in zip(nodes, weights):
+            node_key = tuple(np.round(node, 12))
+            combined[node_key] = combined.get(node_key, 0.) + coeff*weight
+    nodes = np.array(list(combined.keys()), dtype=float).reshape(-1, ndim)
+    weights = np.array(list(combined.values()), dtype=float)
+    return nodes, weights
+
+#
+#   Helper Functions
+#
+
+def _gauss_hermite_1d(num_nodes):
+    # Probabilists' Hermite polynomials, i.e. weight function exp(-x^2/2):
+    nodes, weights = np.polynomial.hermite_e.hermegauss(num_nodes)
+    return nodes, weights/np.sum(weights)
+
+def _tensor_product(rules_1d):
+    nodes = np.stack(np.meshgrid(*[nodes for nodes, _ in rules_1d], indexing='ij'), axis=-1).reshape(-1, len(rules_1d))
+    weights = np.stack(np.meshgrid(*[weights for _, weights in rules_1d], indexing='ij'), axis=-1).reshape(-1, len(rules_1d))
+    return nodes, np.prod(weights, axis=-1)
+
+def _multi_indices(ndim, max_sum):
+    # All multi-indices i with i_k >= 1 and sum(i) <= max_sum:
+    if ndim == 1:
+        for i in range(1, max_sum + 1):
+            yield (i,)
+        return
+    for i in range(1, max_sum - ndim + 2):
+        for rest in _multi_indices(ndim - 1, max_sum - i):
+            yield (i, *rest)
+
+def _binomial(n, k):
+    return factorial(n)//(factorial(k)*factorial(n - k))
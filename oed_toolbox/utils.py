@@ -1,7 +1,9 @@
-from math import pi
+import time
+import warnings
+from collections import OrderedDict
+from math import pi, inf
 import numpy as np
-import jax.numpy as jnp
-from scipy.stats import multivariate_normal as mvn
+from . import profiling, quadrature
 
 #
 #   Function Calls and Pre-Processing
@@ -24,9 +26,17 @@ def _preprocess_inputs(**inputs):
     outputs = tuple([val for key, val in inputs.items() if key != 'use_jax'])
     return outputs if len(outputs) > 1 else outputs[0]
 
+def _array_module(use_jax):
+    # JAX is only imported once a JAX model is actually used:
+    if use_jax:
+        import jax.numpy as jnp
+        return jnp
+    return np
+
 def _ensure_arrays_are_2d(inputs, use_jax):
+    xnp = _array_module(use_jax)
     for key, val in inputs.items(): 
-        val = jnp.atleast_1d(val) if use_jax else np.atleast_1d(val)
+        val = xnp.atleast_1d(val)
         if val.ndim == 1:
             inputs[key] = val[None,:]
         elif val.ndim > 2:
@@ -34,50 +44,139 @@ def _ensure_arrays_are_2d(inputs, use_jax):
     return inputs
 
 def _check_batch_dimension(inputs, use_jax):
-    if use_jax:
-        num_batch = jnp.max(jnp.array([val.shape[0] for val in inputs.values()]))
-    else:
-        num_batch = np.max([val.shape[0] for val in inputs.values()])
+    xnp = _array_module(use_jax)
+    num_batch = xnp.max(xnp.array([val.shape[0] for val in inputs.values()]))
     for key, val in inputs.items():
         if val.shape[0] == 1:
-            if use_jax:
-                inputs[key] = jnp.broadcast_to(val, shape=(num_batch, val.shape[-1]))
-            else:
-                inputs[key] = np.broadcast_to(val, shape=(num_batch, val.shape[-1]))
+            inputs[key] = xnp.broadcast_to(val, shape=(num_batch, val.shape[-1]))
         elif val.shape[0] != num_batch:
             raise ValueError(f'Expected {key} input to have a batch dimension of {num_batch}; ' 
                                 f'instead, it was {val.shape[0]}.')
     return inputs
 
+def _is_shared(val):
+    # An input is 'shared' across the batch if all of its rows are identical, i.e. it's a single row or 
+    # a NumPy array which has been broadcast along its batch dimension (giving a zero stride):
+    if np.ndim(val) < 2 or val.shape[0] == 1:
+        return True
+    return isinstance(val, np.ndarray) and (val.strides[0] == 0)
+
+def _compact_shared_inputs(**inputs):
+    # If every input is shared, only their first rows need to be evaluated - the batch size is also
+    # returned so that outputs can be (lazily) broadcast back with _broadcast_batch:
+    num_batch = max([val.shape[0] if np.ndim(val) > 1 else 1 for val in inputs.values()])
+    if all(_is_shared(val) for val in inputs.values()):
+        inputs = {key: val[:1] if np.ndim(val) > 1 else val for key, val in inputs.items()}
+    return (num_batch, *inputs.values())
+
+def _broadcast_batch(val, num_batch):
+    if val.shape[0] == num_batch:
+        return val
+    return np.broadcast_to(val, (num_batch, *val.shape[1:]))
+
+#
+#   Einsum Contractions
+#
+
+# Optimal contraction paths, keyed by (subscripts, *operand_shapes) - since shapes vary with num_samples, only the 
+# _max_einsum_paths most recently used paths are kept:
+_einsum_paths = OrderedDict()
+_max_einsum_paths = 256
+
+def _einsum(subscripts, *operands):
+    # Multi-operand einsums are otherwise contracted left-to-right; instead, find the optimal contraction
+    # order once for each expression and set of operand shapes, then re-use it on subsequent calls:
+    if len(operands) < 3:
+        return np.einsum(subscripts, *operands)
+    key = (subscripts, *[np.shape(operand) for operand in operands])
+    if key in _einsum_paths:
+        _einsum_paths.move_to_end(key)
+    else:
+        _einsum_paths[key] = np.einsum_path(subscripts, *operands, optimize='optimal')[0]
+        if len(_einsum_paths) > _max_einsum_paths:
+            _einsum_paths.popitem(last=False)
+    return np.einsum(subscripts, *operands, optimize=_einsum_paths[key])
+
 #
 #   Control Variates
 #
 
 def apply_control_variates(val, *cv_list, **cv_dict):
-    # Add singleton dimension if val=loss
-    for _ in range(2-val.ndim):
-        val = val[:, None] 
-    cv_vec = []
-    for cv in [*cv_list, *cv_dict.values()]:
-        num_samples, size = cv.shape[0], np.prod(cv.shape[1:], dtype=int)
-        cv_vec.append(cv.reshape(num_samples, size))
-    cv_vec = np.concatenate(cv_vec, axis=1)
-    val_vec = val.reshape(val.shape[0], np.prod(val.shape[1:], dtype=int))
-    cv_var = _compute_covariance(cv_vec, cv_vec)
-    val_cv_cov = _compute_covariance(cv_vec, val_vec-np.mean(val_vec,axis=0))
-    a = _solve_for_a(cv_var, val_cv_cov)
-    val_vec = np.mean(val_vec - np.einsum("ji,aj->ai", a, cv_vec), axis=0)
-    return val_vec.reshape(val.shape[1:])
-
-def _compute_covariance(vec1, vec2):
-    return np.mean(np.einsum('ai,aj->aij', vec1, vec2), axis=0)
+    stats = _sample_statistics(val, [*cv_list, *cv_dict.values()])
+    return _estimate_from_statistics(stats)
+
+def _sample_statistics(val, cv_list=(), weights=None, num_groups=None):
+    # Sums over the sample dimension - these can be added together across batches of samples, so the
+    # final (control variate) estimate doesn't depend on how samples were split up. If importance weights
+    # are specified, these become weighted sums, giving self-normalised estimates. If num_groups is specified, 
+    # val.shape = (num_samples, num_groups, ...) and control variates are fitted separately for each group:
+    num_samples = val.shape[0]
+    groups = 1 if num_groups is None else num_groups
+    val_vec = val.reshape(num_samples, groups, -1)
+    wtd_val_vec = val_vec if weights is None else np.einsum('a,agi->agi', weights, val_vec)
+    stats = {'shape': val.shape[1:], 'num_samples': num_samples if weights is None else np.sum(weights), 
+             'val_sum': np.sum(wtd_val_vec, axis=0)}
+    if len(cv_list) > 0:
+        # Control variate statistics are timed together with the control variate correction in _estimate_from_statistics:
+        with profiling._timer('utils.apply_control_variates'):
+            cv_vec = np.concatenate([cv.reshape(num_samples, groups, -1) for cv in cv_list], axis=-1)
+            wtd_cv_vec = cv_vec if weights is None else np.einsum('a,agi->agi', weights, cv_vec)
+            stats['cv_sum'] = np.sum(wtd_cv_vec, axis=0)
+            stats['cv_cv_sum'] = np.einsum('agi,agj->gij', wtd_cv_vec, cv_vec)
+            stats['cv_val_sum'] = np.einsum('agi,agj->gij', wtd_cv_vec, val_vec)
+    return stats
+
+def _merge_statistics(stats_list):
+    merged = dict(stats_list[0])
+    for stats in stats_list[1:]:
+        for key, val in stats.items():
+            if key != 'shape':
+                merged[key] = merged[key] + val
+    return merged
+
+def _multi_fidelity_statistics(hf_val, lf_val):
+    # The high-fidelity values hf_val were computed for the first hf_val.shape[0] of the samples used to 
+    # compute the low-fidelity values lf_val, so the paired values are correlated:
+    num_samples, num_lf_samples = hf_val.shape[0], lf_val.shape[0]
+    hf_vec, lf_vec = hf_val.reshape(num_samples, -1), lf_val.reshape(num_lf_samples, -1)
+    paired_lf_vec = lf_vec[:num_samples]
+    return {'shape': hf_val.shape[1:], 'num_samples': num_samples, 'val_sum': np.sum(hf_vec, axis=0), 
+            'lf_sum': np.sum(paired_lf_vec, axis=0), 'lf_lf_sum': np.sum(paired_lf_vec**2, axis=0),
+            'lf_val_sum': np.sum(paired_lf_vec*hf_vec, axis=0), 'num_lf_samples': num_lf_samples, 
+            'all_lf_sum': np.sum(lf_vec, axis=0)}
+
+def _estimate_from_statistics(stats):
+    if 'lf_sum' in stats:
+        return _estimate_from_multi_fidelity_statistics(stats)
+    num_samples = stats['num_samples']
+    val_mean = stats['val_sum']/num_samples
+    if 'cv_sum' in stats:
+        with profiling._timer('utils.apply_control_variates'):
+            cv_mean = stats['cv_sum']/num_samples
+            cv_var = stats['cv_cv_sum']/num_samples
+            val_cv_cov = stats['cv_val_sum']/num_samples - np.einsum('gi,gj->gij', cv_mean, val_mean)
+            a = _solve_for_a(cv_var, val_cv_cov)
+            val_mean = val_mean - np.einsum('gji,gj->gi', a, cv_mean)
+    return val_mean.reshape(stats['shape'])
+
+def _estimate_from_multi_fidelity_statistics(stats):
+    # Multi-fidelity Monte Carlo estimate mean_hf + alpha*(mean_lf_all - mean_lf_paired), where each component's
+    # alpha = cov(hf, lf)/var(lf) minimises the variance of that component's estimate:
+    num_samples = stats['num_samples']
+    val_mean = stats['val_sum']/num_samples
+    lf_mean = stats['lf_sum']/num_samples
+    lf_var = stats['lf_lf_sum']/num_samples - lf_mean**2
+    val_lf_cov = stats['lf_val_sum']/num_samples - lf_mean*val_mean
+    alpha = np.divide(val_lf_cov, lf_var, out=np.zeros_like(val_lf_cov), where=lf_var > 0)
+    val_mean = val_mean + alpha*(stats['all_lf_sum']/stats['num_lf_samples'] - lf_mean)
+    return val_mean.reshape(stats['shape'])
 
 def _solve_for_a(cv_var, val_cv_cov, min_eps=1e-9, max_eps=1e-6, eps_increment=1e1):
     eps = 0
     solved = False
     while not solved:
         try:
-            a = np.linalg.solve(cv_var + eps*np.identity(cv_var.shape[0]), val_cv_cov)
+            a = np.linalg.solve(cv_var + eps*np.identity(cv_var.shape[-1]), val_cv_cov)
             solved = True
         except np.linalg.LinAlgError as error:
             if eps == 0:
@@ -88,6 +187,178 @@ def _solve_for_a(cv_var, val_cv_cov, min_eps=1e-9, max_eps=1e-6, eps_increment=1
                 raise error
     return a
 
+#
+#   Sample Recycling
+#
+
+class _SampleRecycler:
+
+    def __init__(self, likelihood, ess_threshold):
+        self._likelihood = likelihood
+        self._ess_threshold = ess_threshold
+        self._samples = None
+
+    def get_samples(self, sample, d, num_samples, rng, theta=None):
+        # Returns {'theta', 'y'} samples and their importance weights (None for freshly drawn samples); stored samples 
+        # drawn at an earlier design are re-used unless their effective sample size has dropped below ess_threshold:
+        recycled = self._reweight(d, num_samples, theta)
+        if recycled is not None:
+            profiling._count('recycler.reused', num_samples)
+            return recycled
+        samples = sample(d, num_samples, rng)
+        proposal_logpdf = self._likelihood.logpdf(samples['y'], samples['theta'], d, return_dy=False)['logpdf']
+        self._samples = {**samples, 'proposal_logpdf': proposal_logpdf}
+        profiling._count('recycler.drawn', num_samples)
+        return samples, None
+
+    def _reweight(self, d, num_samples, theta):
+        if (self._samples is None) or (self._samples['y'].shape[0] != num_samples):
+            return None
+        if (theta is not None) and (not np.array_equal(np.atleast_2d(theta), self._samples['theta'])):
+            return None
+        samples = {'theta': self._samples['theta'], 'y': self._samples['y']}
+        logpdf = self._likelihood.logpdf(samples['y'], samples['theta'], d, return_dy=False)['logpdf']
+        log_wts = logpdf - self._samples['proposal_logpdf']
+        wts = np.exp(log_wts - np.max(log_wts))
+        ess = np.sum(wts)**2/np.sum(wts**2)
+        if ess < self._ess_threshold*num_samples:
+            return None
+        return samples, wts
+
+#
+#   Eigendecompositions
+#
+
+def _extreme_eigenpairs(matrix, largest=False, warm_start=None, block_size=2, dense_threshold=128, tol=1e-8, maxiter=100):
+    # Returns the block_size smallest (or largest) eigenpairs, ordered from the most extreme eigenvalue inwards;
+    # matrix may also be a stack of matrices, in which case the eigenpairs of each matrix are stacked:
+    dim = matrix.shape[-1]
+    block_size = min(block_size, dim)
+    # Iterative solvers are only worthwhile (and reliable) for matrices much larger than the block size:
+    if (dim < dense_threshold) or (dim < 5*block_size):
+        eigvals, eigvecs = np.linalg.eigh(matrix)
+    elif matrix.ndim > 2:
+        if (warm_start is None) or (warm_start.shape[0] != matrix.shape[0]):
+            warm_start = matrix.shape[0]*[None]
+        eigpairs = [_extreme_eigenpairs(matrix_i, largest, warm_start_i, block_size, dense_threshold, tol, maxiter) 
+                    for matrix_i, warm_start_i in zip(matrix, warm_start)]
+        return np.stack([eigvals for eigvals, _ in eigpairs], axis=0), np.stack([eigvecs for _, eigvecs in eigpairs], axis=0)
+    else:
+        eigvals, eigvecs = _lobpcg_eigenpairs(matrix, largest, warm_start, block_size, tol, maxiter)
+    order = np.argsort(eigvals, axis=-1)
+    if largest:
+        order = order[...,::-1]
+    order = order[...,:block_size]
+    return np.take_along_axis(eigvals, order, axis=-1), np.take_along_axis(eigvecs, order[...,None,:], axis=-1)
+
+def _lobpcg_eigenpairs(matrix, largest, warm_start, block_size, tol, maxiter):
+    from scipy.sparse.linalg import lobpcg
+    dim = matrix.shape[-1]
+    if (warm_start is None) or (warm_start.shape != (dim, block_size)):
+        warm_start = np.random.default_rng(0).standard_normal((dim, block_size))
+    with warnings.catch_warnings():
+        # Convergence is checked explicitly below:
+        warnings.simplefilter('ignore')
+        eigvals, eigvecs = lobpcg(matrix, warm_start, largest=largest, tol=tol, maxiter=maxiter)
+    # Fall back on a dense decomposition if LOBPCG hasn't converged:
+    residuals = np.linalg.norm(matrix @ eigvecs - eigvecs*eigvals, axis=0)
+    if (not np.all(np.isfinite(eigvals))) or np.any(residuals > np.sqrt(tol)*max(np.max(np.abs(eigvals)), 1.)):
+        profiling._count('utils.eigh_fallback')
+        return np.linalg.eigh(matrix)
+    return eigvals, eigvecs
+
+#
+#   Estimator Selection
+#
+
+def _select_most_efficient(candidates, estimate_grad, num_repeats):
+    # Efficiency = 1/(total variance of gradient estimates * wall time per estimate):
+    best_candidate, best_efficiency = None, -inf
+    for candidate in candidates:
+        start = time.perf_counter()
+        try:
+            grads = [np.asarray(estimate_grad(candidate)) for _ in range(num_repeats)]
+        except np.linalg.LinAlgError:
+            # e.g. singular control variate covariance with too few pilot samples:
+            continue
+        time_per_estimate = (time.perf_counter() - start)/num_repeats
+        grad_var = np.sum(np.var(np.stack(grads, axis=0), axis=0, ddof=1))
+        cost = grad_var*time_per_estimate
+        efficiency = 1/cost if cost > 0 else inf
+        profiling._count('estimator_selection.pilot', num_repeats)
+        if efficiency > best_efficiency:
+            best_candidate, best_efficiency = candidate, efficiency
+    if best_candidate is None:
+        raise ValueError('Unable to compute gradients for any candidate estimator.')
+    return best_candidate
+
+class _Estimator:
+
+    # Options shared by APE and FisherInformation which can't be used together:
+    _incompatible_options = [('low_fidelity', 'recycle_samples'), ('low_fidelity', 'apply_control_variates'), ('low_fidelity', 'use_closed_form'),
+                             ('quadrature_level', 'low_fidelity'), ('quadrature_level', 'recycle_samples'), ('quadrature_level', 'use_closed_form'),
+                             ('use_closed_form', 'recycle_samples')]
+
+    def _set_estimator_options(self, likelihood, num_pilot_samples, num_pilot_repeats, recycle_samples, ess_threshold, low_fidelity, 
+                               low_fidelity_ratio, quadrature_level, sparse_grid, return_quadrature_error, **other_options):
+        # - num_pilot_samples and num_pilot_repeats control the pilot run used to choose an estimator - see _select_estimator.
+        # - recycle_samples re-uses score function samples drawn at earlier designs, importance-weighted by p(y|theta,d)/p(y|theta,d_old),
+        #   until their effective sample size drops below ess_threshold*num_samples.
+        # - low_fidelity is the same estimator built from a cheap (e.g. surrogate) model, which is evaluated on low_fidelity_ratio times
+        #   as many samples; the expensive estimate only uses the first num_samples of these, and the two are combined with a
+        #   multi-fidelity Monte Carlo estimator.
+        # - quadrature_level replaces sampling with a Gauss-Hermite rule over the base distributions (which must be standard normal, e.g.
+        #   Prior.gaussian and Gaussian noise) - a tensor product of quadrature_level nodes along each dimension or, if sparse_grid=True, 
+        #   a Smolyak sparse grid. If return_quadrature_error=True, an error estimate is also returned.
+        options = {'recycle_samples': recycle_samples, 'low_fidelity': low_fidelity, 'quadrature_level': quadrature_level, **other_options}
+        enabled = [key for key, val in options.items() if (val is not None) and (val is not False)]
+        for first, second in self._incompatible_options:
+            if (first in enabled) and (second in enabled):
+                raise ValueError(f'{first} cannot be combined with {second}.')
+        if (quadrature_level is not None) and (quadrature_level < 1):
+            raise ValueError('quadrature_level must be at least 1.')
+        if return_quadrature_error and ((quadrature_level is None) or (quadrature_level < 2)):
+            raise ValueError('return_quadrature_error requires quadrature_level >= 2, since errors are estimated using the quadrature_level-1 rule.')
+        self._likelihood = likelihood
+        self._num_pilot_samples = num_pilot_samples
+        self._num_pilot_repeats = num_pilot_repeats
+        self._recycler = _SampleRecycler(likelihood, ess_threshold) if recycle_samples else None
+        self._low_fidelity = low_fidelity
+        self._low_fidelity_ratio = low_fidelity_ratio
+        self._quadrature_level = quadrature_level
+        self._sparse_grid = sparse_grid
+        self._return_quadrature_error = return_quadrature_error
+        self._base_dims = None
+
+    def _quadrature_estimate(self, estimate, *distributions):
+        # Quadrature estimates aren't random, so no samples are used and the estimator is never automatically selected. 
+        # estimate(nodes, weights) is called with nodes split between the base distributions of distributions:
+        if self._base_dims is None:
+            rng = np.random.default_rng(0)
+            self._base_dims = [distribution.sample_base(1, rng).shape[-1] for distribution in distributions]
+        def estimate_at_level(level):
+            nodes, weights = quadrature.quadrature_rule(sum(self._base_dims), level, self._sparse_grid)
+            return estimate(np.split(nodes, np.cumsum(self._base_dims)[:-1], axis=-1), weights)
+        outputs = estimate_at_level(self._quadrature_level)
+        if not self._return_quadrature_error:
+            return outputs, None
+        # Gauss-Hermite rules aren't nested, so the error estimate (i.e. the difference from the quadrature_level-1 estimate) 
+        # requires a second full evaluation:
+        coarse_outputs = estimate_at_level(self._quadrature_level - 1)
+        return outputs, {key: np.abs(val - coarse_outputs[key]) for key, val in outputs.items()}
+
+    def _select_estimator(self, candidates, pilot_grad, num_samples, num_repeats):
+        # Commit to the candidate estimator with the smallest gradient variance per unit of wall time, where
+        # pilot_grad(candidate, num_samples) returns a single gradient estimate:
+        if num_samples is None:
+            num_samples = self._num_pilot_samples
+        if num_repeats is None:
+            num_repeats = self._num_pilot_repeats
+        self._estimator = _select_most_efficient(candidates, lambda candidate : pilot_grad(candidate, num_samples), num_repeats)
+        # Only run the pilot automatically on the first call:
+        self._auto_select = False
+        return dict(self._estimator)
+
 #
 #   Gaussian Functions
 #
@@ -112,6 +383,7 @@ def _get_cov_chol(cov, cov_chol):
     return cov_chol
 
 def unit_gaussian_sample(ndim, num_samples, rng):
+    from scipy.stats import multivariate_normal as mvn
     return mvn.rvs(mean=np.zeros(ndim), cov=np.identity(ndim), size=num_samples, random_state=rng).reshape(num_samples, ndim)
 
 def gaussian_logpdf(x, mean, cov, icov=None):
@@ -120,7 +392,7 @@ def gaussian_logpdf(x, mean, cov, icov=None):
     is_batched = True
     mean, cov, icov = _reshape_mean_and_cov(is_batched, mean, cov, icov)
     x_dim = mean.shape[-1]
-    return -0.5*x_dim*np.log(2*pi) - 0.5*np.einsum('ai,aij,aj->a', x-mean, icov, x-mean) - 0.5*np.log(np.linalg.det(cov))
+    return -0.5*x_dim*np.log(2*pi) - 0.5*_einsum('ai,aij,aj->a', x-mean, icov, x-mean) - 0.5*np.log(np.linalg.det(cov))
 
 def _reshape_mean_and_cov(is_batched, mean, *cov_tuple):
     cov_list = list(cov_tuple)
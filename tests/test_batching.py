@@ -0,0 +1,22 @@
+import numpy as np
+from oed_toolbox import batching, losses, models, optim
+
+def create_model():
+    # g(theta, d) = theta^2 * d:
+    return models.Model(model=lambda theta, d : theta**2*d,
+                        model_dt=lambda theta, d : (2*theta*d)[:,:,None],
+                        model_dd=lambda theta, d : (theta**2)[:,:,None],
+                        model_dt_dt=lambda theta, d : (2*d)[:,:,None,None],
+                        model_dt_dd=lambda theta, d : (2*theta)[:,:,None,None])
+
+def test_laplace_ape_with_micro_batched_model():
+    model = create_model()
+    laplace_args = (optim.gradient_descent_for_map(), np.ones(1), np.identity(1), 0.1*np.identity(1))
+    d = np.array([1.])
+    expected_loss, expected_grad = \
+    losses.APE.using_laplace_approximation(model, *laplace_args)(d, num_samples=10, rng=np.random.default_rng(0))
+    # MicroBatchedModel doesn't provide derivative contractions, so dense derivatives must be used instead:
+    with batching.MicroBatchedModel(model) as batched_model:
+        loss, grad = losses.APE.using_laplace_approximation(batched_model, *laplace_args)(d, num_samples=10, rng=np.random.default_rng(0))
+    assert np.allclose(loss, expected_loss)
+    assert np.allclose(grad, expected_grad)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from oed_toolbox import compilation
+
+jax = pytest.importorskip('jax')
+
+PARAMS = {'w': np.zeros(2000)}
+
+def surrogate(x):
+    return x*PARAMS['w'][1000]
+
+def _helper(x):
+    return 2*x
+
+HELPER = jax.jit(_helper)
+
+def uses_helper(x):
+    return HELPER(x)
+
+class _Opaque:
+    pass
+
+OPAQUE = _Opaque()
+
+def uses_opaque(x):
+    return OPAQUE, x
+
+def test_function_key_changes_with_array_inside_global_dict(monkeypatch):
+    key = compilation._function_key(surrogate)
+    # repr would truncate this array, so changing a single entry mustn't be missed:
+    w = np.zeros(2000)
+    w[1000] = 1.
+    monkeypatch.setitem(PARAMS, 'w', w)
+    assert compilation._function_key(surrogate) != key
+
+def test_function_key_is_stable_for_recreated_globals(monkeypatch):
+    key = compilation._function_key(uses_helper)
+    # Same function, but a different object (and so a different memory address), as in a new process:
+    monkeypatch.setitem(globals(), 'HELPER', jax.jit(_helper))
+    assert compilation._function_key(uses_helper) == key
+
+def test_function_key_rejects_unidentifiable_globals():
+    with pytest.raises(ValueError, match='cache_key'):
+        compilation._function_key(uses_opaque)
@@ -0,0 +1,37 @@
+import numpy as np
+from oed_toolbox import covariances, distributions, models
+
+def create_likelihood():
+    # g(theta, d) = theta^2 * d, plus Gaussian noise:
+    model = models.Model(model=lambda theta, d : theta**2*d,
+                         model_dt=lambda theta, d : (2*theta*d)[:,:,None],
+                         model_dd=lambda theta, d : (theta**2)[:,:,None],
+                         model_dt_dt=lambda theta, d : (2*d)[:,:,None,None],
+                         model_dt_dd=lambda theta, d : (2*theta)[:,:,None,None])
+    return distributions.Likelihood.from_model_plus_constant_gaussian_noise(model, 0.1*np.identity(1))
+
+def test_closed_form_fisher_information_matches_sampled_estimate():
+    likelihood = create_likelihood()
+    d, theta_estimate = np.array([1.]), np.array([1.5])
+    closed_form = covariances.FisherInformation(likelihood)
+    sampled = covariances.FisherInformation(likelihood, use_closed_form=False)
+    expected = closed_form(d, theta_estimate)
+    outputs = sampled(d, theta_estimate, num_samples=50000, rng=np.random.default_rng(0))
+    for key in ('cov', 'cov_dd'):
+        assert np.allclose(outputs[key], expected[key], rtol=0.05)
+
+def test_batched_fisher_information_matches_per_estimate_calls():
+    likelihood = create_likelihood()
+    d, theta_estimates = np.array([1.]), np.array([[0.5], [1.], [1.5]])
+    num_samples, num_estimates = 20, theta_estimates.shape[0]
+    # Samples of shape (num_samples, num_estimates, y_dim), where samples[:,k] are drawn for theta_estimates[k]:
+    rng = np.random.default_rng(0)
+    samples = np.stack([likelihood.sample(theta, d, num_samples, rng) for theta in theta_estimates], axis=1)
+    for fisher_info, kwargs in [(covariances.FisherInformation(likelihood), {}),
+                                (covariances.FisherInformation(likelihood, use_closed_form=False), {'samples': samples})]:
+        batched = fisher_info(d, theta_estimates, **kwargs)
+        for k in range(num_estimates):
+            per_estimate_kwargs = {'samples': samples[:,k]} if kwargs else {}
+            expected = fisher_info(d, theta_estimates[k], **per_estimate_kwargs)
+            for key in ('cov', 'cov_dd'):
+                assert np.allclose(batched[key][k], expected[key])
@@ -0,0 +1,13 @@
+import subprocess
+import sys
+import time
+
+def test_import_does_not_load_jax_or_scipy():
+    # Run in a fresh interpreter, since other tests may already have imported jax or scipy:
+    code = "import sys, oed_toolbox, oed_toolbox.losses; print(','.join(name for name in ('jax', 'scipy') if name in sys.modules))"
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    wall_time = time.perf_counter() - start
+    assert result.stdout.strip() == ''
+    # Generous bound, which should only be exceeded if a heavy dependency is imported eagerly again:
+    assert wall_time < 5.
@@ -0,0 +1,45 @@
+import numpy as np
+from oed_toolbox import covariances, distributions, losses, models, optim, parallel
+
+PRIOR_MEAN, PRIOR_COV, NOISE_COV = np.ones(1), np.identity(1), 0.1*np.identity(1)
+
+def create_model():
+    # g(theta, d) = theta^2 * d:
+    return models.Model(model=lambda theta, d : theta**2*d,
+                        model_dt=lambda theta, d : (2*theta*d)[:,:,None],
+                        model_dd=lambda theta, d : (theta**2)[:,:,None],
+                        model_dt_dt=lambda theta, d : (2*d)[:,:,None,None],
+                        model_dt_dd=lambda theta, d : (2*theta)[:,:,None,None])
+
+# Factories are module-level functions, so that they can be sent to the pool's workers:
+def create_ape():
+    return losses.APE.using_laplace_approximation(create_model(), optim.gradient_descent_for_map(), PRIOR_MEAN, PRIOR_COV, NOISE_COV)
+
+def create_likelihood():
+    return distributions.Likelihood.from_model_plus_constant_gaussian_noise(create_model(), NOISE_COV)
+
+def create_fisher_information():
+    return covariances.FisherInformation(create_likelihood(), apply_control_variates=True, use_closed_form=False)
+
+def test_sharded_ape_matches_single_process():
+    d = np.array([1.])
+    rng = np.random.default_rng(0)
+    theta = distributions.Prior.gaussian(PRIOR_MEAN, PRIOR_COV).sample(20, rng)
+    samples = {'theta': theta, 'y': create_likelihood().sample(theta, d, 20, rng)}
+    ape = create_ape()
+    for apply_control_variates in (False, True):
+        expected_loss, expected_grad = ape(d, samples=samples, apply_control_variates=apply_control_variates)
+        with parallel.ShardPool(create_ape, num_workers=2) as pool:
+            loss, grad = ape(d, samples=samples, apply_control_variates=apply_control_variates, pool=pool)
+        assert np.allclose(loss, expected_loss)
+        assert np.allclose(grad, expected_grad)
+
+def test_sharded_fisher_information_matches_single_process():
+    d, theta_estimate = np.array([1.]), np.array([1.])
+    samples = create_likelihood().sample(theta_estimate, d, 20, np.random.default_rng(0))
+    fisher_info = create_fisher_information()
+    expected = fisher_info(d, theta_estimate, samples=samples)
+    with parallel.ShardPool(create_fisher_information, num_workers=2) as pool:
+        outputs = fisher_info(d, theta_estimate, samples=samples, pool=pool)
+    for key in ('cov', 'cov_dd'):
+        assert np.allclose(outputs[key], expected[key])
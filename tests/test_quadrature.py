@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from oed_toolbox import covariances, distributions, models, quadrature
+
+def expectation(func, nodes, weights):
+    return np.sum(weights*func(nodes))
+
+@pytest.mark.parametrize('rule', [quadrature.gauss_hermite, quadrature.smolyak_gauss_hermite])
+def test_rules_integrate_gaussian_moments_exactly(rule):
+    nodes, weights = rule(2, 3)
+    assert np.isclose(np.sum(weights), 1.)
+    # Moments of x, y ~ N(0, 1):
+    assert np.isclose(expectation(lambda z : z[:,0]**2, nodes, weights), 1.)
+    assert np.isclose(expectation(lambda z : z[:,0]**4, nodes, weights), 3.)
+    assert np.isclose(expectation(lambda z : z[:,0]**2*z[:,1]**2, nodes, weights), 1.)
+    assert np.isclose(expectation(lambda z : z[:,0]**3*z[:,1], nodes, weights), 0.)
+
+def test_quadrature_fisher_information_matches_closed_form():
+    # g(theta, d) = theta^2 * d, plus Gaussian noise:
+    model = models.Model(model=lambda theta, d : theta**2*d,
+                         model_dt=lambda theta, d : (2*theta*d)[:,:,None],
+                         model_dd=lambda theta, d : (theta**2)[:,:,None],
+                         model_dt_dt=lambda theta, d : (2*d)[:,:,None,None],
+                         model_dt_dd=lambda theta, d : (2*theta)[:,:,None,None])
+    likelihood = distributions.Likelihood.from_model_plus_constant_gaussian_noise(model, 0.1*np.identity(1))
+    d, theta_estimate = np.array([1.]), np.array([1.5])
+    expected = covariances.FisherInformation(likelihood)(d, theta_estimate)
+    outputs = covariances.FisherInformation(likelihood, quadrature_level=3)(d, theta_estimate)
+    for key in ('cov', 'cov_dd'):
+        assert np.allclose(outputs[key], expected[key])